@@ -1,58 +1,304 @@
 # coding=utf-8
 # MAnorm的输入输出都在这个脚本里面处理
-from numpy.ma import log2, log10
-import matplotlib
+from array import array
+from collections import OrderedDict
+from math import log
+from multiprocessing import Pool
+import gzip
+import os
+
+from read_cache import read_cache_key, load_cached_reads, save_cached_reads, remove_cached_reads
+from peaks import PeakTable, get_peaks_mavalues, get_peaks_normed_mavalues, get_peaks_log_pvalues, \
+    _sort_peaks_list
+from plots import draw_figs_to_show_data
 
-from peaks import Peak, get_peaks_mavalues, get_peaks_normed_mavalues, get_peaks_pvalues, \
-    _add_peaks, _sort_peaks_list
-
-
-matplotlib.use('Agg')
-from matplotlib import pyplot as plt
 import numpy as np
+import pandas as pd
 import pysam
 
-def _get_reads_position(reads_fp, shift):
+# 按块读取bed格式的read文件时每块的行数
+BED_CHUNK_SIZE = 1000000
+# SAM flag中读取bam文件时需要过滤的位
+BAM_FUNMAP, BAM_FSECONDARY, BAM_FDUP, BAM_FSUPPLEMENTARY = 0x4, 0x100, 0x400, 0x800
+# 读取bam文件的方式: auto按窗口总长度自动选择, genome读取所有read, regions只读取peaks窗口内的read
+BAM_FETCH_MODES = ('auto', 'genome', 'regions')
+# auto模式下窗口总长度不超过基因组长度的这个比例时只读取窗口内的read
+REGION_FETCH_MAX_FRACTION = 0.1
+# 间距小于此值的相邻窗口合并成一次fetch
+REGION_MERGE_GAP = 5000
+# 可选的列式输出格式
+COLUMNAR_FORMATS = ('parquet', 'npz')
+# 轨迹文件中每个peak从summit开始覆盖的长度
+TRACK_SPAN = 100
+# 多个延伸长度比较报告的列和格式
+EXTENSION_SWEEP_COLUMNS = (('extension', '%d'), ('min_summit_dist', '%d'), ('fit_points', '%d'),
+                           ('slope', '%f'), ('intercept', '%f'), ('fit_scale', '%f'), ('converged', '%s'),
+                           ('common_M_sd', '%f'), ('unique1_M_mean', '%f'), ('unique2_M_mean', '%f'),
+                           ('log2_read_density_corr', '%f'))
+
+
+def _narrow_positions(pos):
+    """
+    位点范围允许时用int32保存以节省内存，否则用int64; 类型已经相同时不复制
+    """
+    if pos.size == 0 or (pos.min() >= np.iinfo(np.int32).min and pos.max() <= np.iinfo(np.int32).max):
+        return pos.astype(np.int32, copy=False)
+    return pos.astype(np.int64, copy=False)
+
+
+def _to_position_array(position):
+    """
+    将一条染色体上的read位点转换成排好序的numpy数组，位点范围允许时用int32保存以节省内存
+    :param position: read位点序列(array.array('l')或numpy数组)
+    :return: 升序排列的numpy数组
+    """
+    if isinstance(position, array):
+        position = np.frombuffer(position, dtype=np.int_).astype(np.int64)
+    pos = _narrow_positions(np.asarray(position))
+    # 已经有序时不再排序; 按坐标排序的文件中两条链的位点交错, 几乎有序, numpy的排序也很快
+    if not _is_sorted(pos):
+        pos.sort()
+    return pos
+
+
+def _is_sorted(pos):
+    return pos.size < 2 or bool((pos[1:] >= pos[:-1]).all())
+
+
+def _open_reads_file(reads_fp):
+    """
+    打开read文件，以.gz结尾的文件按gzip压缩格式读取
+    """
+    if reads_fp.endswith('.gz'):
+        return gzip.open(reads_fp, 'rb')
+    return open(reads_fp)
+
+
+def _iter_bed_chunks(reads_fp, shift, chunksize=BED_CHUNK_SIZE):
+    """
+    按块读取bed格式的read文件，每次批量解析chunksize行，支持.gz压缩文件的流式读取
+    :param reads_fp: read文件路径
+    :param shift: <int>平移量
+    :param chunksize: 每块读取的行数
+    :return: 生成器, 每块返回(染色体名列表, 每行的染色体编号数组, 平移后的位点数组)
+    """
+    reader = pd.read_csv(reads_fp, sep='\t', header=None, usecols=[0, 1, 2, 5], comment='#',
+                         dtype={0: 'category', 1: np.int64, 2: np.int64, 5: 'category'},
+                         compression='infer', chunksize=chunksize)
+    for chunk in reader:
+        chrm = chunk[0].cat
+        is_plus = (chunk[5] == '+').values
+        pos = np.where(is_plus, chunk[1].values + shift, chunk[2].values - shift)
+        yield list(chrm.categories), np.asarray(chrm.codes), pos
+
+
+def _get_reads_position(reads_fp, shift, chunksize=BED_CHUNK_SIZE):
     """
     从read文件中获取所有read的点位置信息，我们将read的位置当成点来处理。
-    read文件要求前三列是chr, start, end,第六列是strand(bed格式), 列之间以\t分隔
+    read文件要求前三列是chr, start, end,第六列是strand(bed格式), 列之间以\t分隔,
+    可以是gzip压缩的.bed.gz文件。文件按块读取，每块的位点先转换成最终的类型(通常是int32)再保存，
+    内存占用是一块的数据、所有位点(最终类型)以及合并时最大一条染色体的一份拷贝
     :param shift: <int>平移量
     :param reads_fp: read文件路径
-    :return: 所有read记录的位点
+    :param chunksize: 每块读取的行数
+    :return: 所有read记录的位点, {chrm: 升序的numpy数组}
     """
+    parts = {}
+    for chrms, codes, pos in _iter_bed_chunks(reads_fp, shift, chunksize):
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.searchsorted(codes[order], np.arange(len(chrms) + 1))
+        for i, chrm in enumerate(chrms):
+            if bounds[i + 1] > bounds[i]:
+                parts.setdefault(chrm, []).append(_narrow_positions(pos[order[bounds[i]:bounds[i + 1]]]))
+    # 返回排序后的reads的位点信息, 每合并完一条染色体就释放它的分块
     position = {}
-    with open(reads_fp) as fi:
-        for li in fi:
-            sli = li.split('\t')
-            chrm, start, end, strand = sli[0].strip(), int(sli[1]), int(sli[2]), sli[5].strip()
-            pos = start + shift if strand is '+' else end - shift
-            try:
-                position[chrm].append(pos)
-            except KeyError:
-                position[chrm] = []
-                position[chrm].append(pos)
-    # 返回排序后的reads的位点信息
-    return {key: sorted(position[key]) for key in position.keys()}
+    for chrm in list(parts.keys()):
+        position[chrm] = _to_position_array(np.concatenate(parts.pop(chrm)))
+    return position
+
 
-def _get_bam_position(reads_fp,shift):
+def _bam_flag_mask(keep_dup):
     """
-    read bam file
+    需要过滤掉的read的flag: unmapped, secondary和supplementary, 以及(默认)标记为duplicate的read
+    """
+    mask = BAM_FUNMAP | BAM_FSECONDARY | BAM_FSUPPLEMENTARY
+    if not keep_dup:
+        mask |= BAM_FDUP
+    return mask
+
+
+def _fetch_bam_chromosome(args):
+    """
+    利用bam索引读取一条染色体上的reads，边读边做flag和MAPQ过滤，供进程池调用
+    :param args: (bam文件路径, 染色体名, 平移量, 最小MAPQ, 是否保留duplicate, BGZF解压线程数)
+    :return: (染色体名, 升序的位点数组)
+    """
+    reads_fp, chrm, shift, min_mapq, keep_dup, threads = args
+    flag_mask = _bam_flag_mask(keep_dup)
+    position = array('l')
+    with pysam.AlignmentFile(reads_fp, 'rb', threads=threads) as samfile:
+        for read in samfile.fetch(chrm):
+            if read.flag & flag_mask or read.mapping_quality < min_mapq:
+                continue
+            if read.is_reverse:
+                position.append(read.reference_end - shift)
+            else:
+                position.append(read.reference_start + shift)
+    return chrm, _to_position_array(position)
+
+
+def _get_bam_position(reads_fp, shift, threads=1, min_mapq=0, keep_dup=False):
+    """
+    read bam file. If the bam file is indexed, chromosomes are fetched concurrently
+    across a process pool; otherwise the file is scanned once from start to end.
     :param reads_fp: <str>read file path
     :param shift: <int>The arbitrary shift size in bp
-    :return: all read position after shift
+    :param threads: <int>number of processes (and BGZF decompression threads)
+    :param min_mapq: <int>reads with mapping quality lower than this are skipped
+    :param keep_dup: <bool>keep reads flagged as PCR/optical duplicate
+    :return: all read position after shift, {chrm: sorted numpy array}
+    """
+    with pysam.AlignmentFile(reads_fp, 'rb') as samfile:
+        has_index = samfile.has_index()
+        chrms = [chrm for (chrm, length) in
+                 sorted(zip(samfile.references, samfile.lengths), key=lambda x: -x[1])]
+    if not has_index:
+        return _scan_bam_position(reads_fp, shift, threads, min_mapq, keep_dup)
+
+    processes = max(1, min(threads, len(chrms)))
+    # 每个进程分到的BGZF解压线程数
+    bgzf_threads = max(1, threads // processes)
+    tasks = [(reads_fp, chrm, shift, min_mapq, keep_dup, bgzf_threads) for chrm in chrms]
+    if processes == 1:
+        results = map(_fetch_bam_chromosome, tasks)
+    else:
+        # 染色体按长度从大到小分发，使各进程的负载尽量均衡
+        pool = Pool(processes)
+        try:
+            results = pool.imap_unordered(_fetch_bam_chromosome, tasks)
+            results = list(results)
+        finally:
+            pool.close()
+            pool.join()
+    return {chrm: pos for (chrm, pos) in results if pos.size > 0}
+
+
+def read_regions(tables, ext, merge_gap=REGION_MERGE_GAP):
+    """
+    计算read密度时需要的read位点范围：每个peak的[start, end)和summit两边各延伸ext + 1。
+    合并后的common peaks由相互重叠的peaks组成，它的summit窗口也在这些范围之内
+    :param tables: 两个样本的peaks表列表
+    :param ext: 窗口从summit左右扩展的长度
+    :param merge_gap: 间距小于此值的范围合并在一起
+    :return: {chrm: (starts, ends)}, 每条染色体上互不重叠的升序范围[start, end)
+    """
+    regions = {}
+    chrms = []
+    for pks in tables:
+        chrms += [chrm for chrm in pks.keys() if chrm not in chrms]
+    for chrm in chrms:
+        lo, hi = [], []
+        for pks in tables:
+            chrm_lo, chrm_hi = pks.chrm_range(chrm)
+            summits = pks.summit[chrm_lo:chrm_hi]
+            lo.append(np.minimum(pks.start[chrm_lo:chrm_hi], summits) - ext - 1)
+            hi.append(np.maximum(pks.end[chrm_lo:chrm_hi], summits) + ext + 2)
+        lo, hi = np.concatenate(lo), np.concatenate(hi)
+        order = np.argsort(lo, kind='mergesort')
+        # 平移后的位点可能小于0, 范围的起点不截断, 只在fetch时截断
+        lo, hi = lo[order], np.maximum.accumulate(hi[order])
+        heads = np.flatnonzero(np.r_[True, lo[1:] > hi[:-1] + merge_gap])
+        regions[chrm] = (lo[heads], np.r_[hi[heads[1:] - 1], hi[-1]])
+    return regions
+
+
+def regions_size(regions):
+    """
+    所有范围的总长度
+    """
+    return sum(int((ends - starts).sum()) for (starts, ends) in regions.values())
+
+
+def _fetch_bam_regions(args):
+    """
+    利用bam索引只读取一条染色体上若干范围内的reads，供进程池调用。
+    平移后的位点落在范围[start, end)内的read才保留，跨越两个范围的read不会被重复计入
+    :param args: (bam文件路径, 染色体名, 范围起点数组, 范围终点数组, 平移量, 最小MAPQ, 是否保留duplicate, BGZF解压线程数)
+    :return: (染色体名, 升序的位点数组)
     """
-    position = {}    
-    with pysam.AlignmentFile(reads_fp,"rb") as samfile:
-        for read in samfile.fetch():
-            chrm,start,end,strand = samfile.getrname(read.tid),read.pos,read.aend,"-" if read.is_reverse==True else "+"
-            pos = start + shift if strand is "+" else end - shift
+    reads_fp, chrm, starts, ends, shift, min_mapq, keep_dup, threads = args
+    flag_mask = _bam_flag_mask(keep_dup)
+    margin = abs(shift)
+    position = array('l')
+    with pysam.AlignmentFile(reads_fp, 'rb', threads=threads) as samfile:
+        for (start, end) in zip(starts.tolist(), ends.tolist()):
+            for read in samfile.fetch(chrm, max(0, start - margin), end + margin):
+                if read.flag & flag_mask or read.mapping_quality < min_mapq:
+                    continue
+                pos = read.reference_end - shift if read.is_reverse else read.reference_start + shift
+                if start <= pos < end:
+                    position.append(pos)
+    return chrm, _to_position_array(position)
+
+
+def _get_bam_region_position(reads_fp, shift, regions, threads=1, min_mapq=0, keep_dup=False):
+    """
+    只读取regions范围内的reads(bam文件需要有索引)
+    :param regions: {chrm: (starts, ends)}, 见read_regions
+    :return: 范围内read的位点, {chrm: 升序的numpy数组}
+    """
+    with pysam.AlignmentFile(reads_fp, 'rb') as samfile:
+        references = set(samfile.references)
+    chrms = sorted([chrm for chrm in regions if chrm in references], key=lambda chrm: -regions[chrm][0].size)
+    processes = max(1, min(threads, len(chrms)))
+    bgzf_threads = max(1, threads // processes)
+    tasks = [(reads_fp, chrm, regions[chrm][0], regions[chrm][1], shift, min_mapq, keep_dup, bgzf_threads)
+             for chrm in chrms]
+    if processes == 1:
+        results = map(_fetch_bam_regions, tasks)
+    else:
+        pool = Pool(processes)
+        try:
+            results = list(pool.imap_unordered(_fetch_bam_regions, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    return {chrm: pos for (chrm, pos) in results if pos.size > 0}
+
+
+def _use_region_fetch(reads_fp, regions, fetch_mode):
+    """
+    判断是否只读取窗口范围内的reads: 需要bam索引, auto模式下窗口总长度不超过基因组的REGION_FETCH_MAX_FRACTION
+    """
+    if regions is None or fetch_mode == 'genome':
+        return False
+    with pysam.AlignmentFile(reads_fp, 'rb') as samfile:
+        if not samfile.has_index():
+            if fetch_mode == 'regions':
+                print '@warning: %s has no index, all reads are loaded' % reads_fp
+            return False
+        genome_size = sum(samfile.lengths)
+    return fetch_mode == 'regions' or regions_size(regions) <= REGION_FETCH_MAX_FRACTION * genome_size
+
+
+def _scan_bam_position(reads_fp, shift, threads=1, min_mapq=0, keep_dup=False):
+    """
+    没有索引的bam文件只能从头到尾读取一遍
+    """
+    flag_mask = _bam_flag_mask(keep_dup)
+    position = {}
+    with pysam.AlignmentFile(reads_fp, 'rb', threads=threads) as samfile:
+        for read in samfile.fetch(until_eof=True):
+            if read.flag & flag_mask or read.mapping_quality < min_mapq:
+                continue
+            pos = read.reference_end - shift if read.is_reverse else read.reference_start + shift
             try:
-                position[chrm].append(pos)
+                position[read.reference_id].append(pos)
             except KeyError:
-                position[chrm]=[]
-                position[chrm].append(pos)
-        return {key: sorted(position[key]) for key in position.keys()}
-            
+                position[read.reference_id] = array('l')
+                position[read.reference_id].append(pos)
+        return {samfile.get_reference_name(tid): _to_position_array(position[tid]) for tid in position.keys()}
+
 
 def _get_read_length(reads_fp):
     """
@@ -60,20 +306,149 @@ def _get_read_length(reads_fp):
     :param reads_fp: read文件
     :return: read长度
     """
-    with open(reads_fp) as fi:
+    with _open_reads_file(reads_fp) as fi:
         for li in fi:
             sli = li.split('\t')
             return int(sli[2]) - int(sli[1])
 
 
-def read_reads(reads_fp, shift):
+class SortedReads(object):
+    """
+    按坐标排序的read文件(bed/bed.gz或bam)，计算read数时逐条染色体读取，
+    内存中只保留一条染色体的read位点。同一条染色体的reads在文件中不连续时(文件没有排序)，
+    提示后改为读取整个文件
+    """
+
+    def __init__(self, reads_fp, shift, threads=1, min_mapq=0, keep_dup=False, regions=None):
+        """
+        :param regions: 只读取这些范围内的reads(有索引的bam文件), 见read_regions
+        其它参数见read_reads
+        """
+        self.reads_fp, self.shift, self.threads = reads_fp, shift, threads
+        self.min_mapq, self.keep_dup, self.regions = min_mapq, keep_dup, regions
+
+    def iter_chromosomes(self, chrms=None):
+        """
+        逐条染色体返回read位点
+        :param chrms: 需要的染色体，None表示所有染色体
+        :return: 生成器, 每次返回(chrm, 升序的numpy数组)；文件没有排序时已经返回过的染色体会再返回一次完整的结果
+        """
+        wanted = set(chrms) if chrms is not None else None
+        if ".bam" in self.reads_fp:
+            with pysam.AlignmentFile(self.reads_fp, 'rb') as samfile:
+                has_index, references = samfile.has_index(), list(samfile.references)
+            if has_index:
+                for chrm in references:
+                    if wanted is not None and chrm not in wanted:
+                        continue
+                    if self.regions is None:
+                        yield _fetch_bam_chromosome((self.reads_fp, chrm, self.shift, self.min_mapq, self.keep_dup,
+                                                     self.threads))
+                    elif chrm in self.regions:
+                        yield _fetch_bam_regions((self.reads_fp, chrm, self.regions[chrm][0], self.regions[chrm][1],
+                                                  self.shift, self.min_mapq, self.keep_dup, self.threads))
+                return
+            runs = self._iter_bam_runs()
+        else:
+            runs = self._iter_bed_runs()
+        # 把相邻的同一条染色体的片段拼起来，染色体变化时输出上一条
+        done, current, parts = set(), None, []
+        for (chrm, pos) in runs:
+            if chrm != current:
+                if parts:
+                    yield current, _to_position_array(np.concatenate(parts))
+                done.add(current)
+                current, parts = chrm, []
+                if chrm in done and (wanted is None or chrm in wanted):
+                    print '@warning: %s is not sorted by coordinate, all reads are loaded' % self.reads_fp
+                    for item in self._load_all().iteritems():
+                        yield item
+                    return
+            if wanted is None or chrm in wanted:
+                parts.append(_narrow_positions(pos))
+        if parts:
+            yield current, _to_position_array(np.concatenate(parts))
+
+    def _iter_bed_runs(self):
+        """
+        按文件顺序返回(染色体名, 位点数组)片段，每个片段内染色体相同
+        """
+        for (chrms, codes, pos) in _iter_bed_chunks(self.reads_fp, self.shift):
+            bounds = np.r_[0, np.flatnonzero(codes[1:] != codes[:-1]) + 1, codes.size]
+            for (lo, hi) in zip(bounds[:-1], bounds[1:]):
+                yield chrms[codes[lo]], pos[lo:hi]
+
+    def _iter_bam_runs(self):
+        """
+        没有索引的bam文件从头到尾读取一遍, 按文件顺序返回(染色体名, 位点数组)片段
+        """
+        flag_mask = _bam_flag_mask(self.keep_dup)
+        current, position = None, array('l')
+        with pysam.AlignmentFile(self.reads_fp, 'rb', threads=self.threads) as samfile:
+            for read in samfile.fetch(until_eof=True):
+                if read.flag & flag_mask or read.mapping_quality < self.min_mapq:
+                    continue
+                if read.reference_id != current:
+                    if len(position):
+                        yield samfile.get_reference_name(current), np.frombuffer(position, dtype=np.int_)
+                    current, position = read.reference_id, array('l')
+                position.append(read.reference_end - self.shift if read.is_reverse
+                                else read.reference_start + self.shift)
+            if len(position):
+                yield samfile.get_reference_name(current), np.frombuffer(position, dtype=np.int_)
+
+    def _load_all(self):
+        if ".bam" in self.reads_fp:
+            return _scan_bam_position(self.reads_fp, self.shift, self.threads, self.min_mapq, self.keep_dup)
+        return _get_reads_position(self.reads_fp, self.shift)
+
+
+def read_reads(reads_fp, shift, threads=1, min_mapq=0, keep_dup=False, cache_dir=None, refresh_cache=False,
+               regions=None, fetch_mode='auto', stream=False):
+    """
+    读取read文件, 支持bed(.bed/.bed.gz)和bam格式。
+    指定cache_dir时，解析后的位点会写入磁盘缓存，之后相同文件和参数的读取直接内存映射缓存。
+    指定regions时，有索引的bam文件可以只读取这些范围内的reads(不写入缓存)，结果只能用于计算这些范围内窗口的read数。
+    stream为True且没有可用的缓存时返回SortedReads，计算read数时才逐条染色体读取
+    :param reads_fp: read文件路径
+    :param shift: <int>平移量
+    :param threads: <int>读取bam文件时使用的进程数
+    :param min_mapq: <int>bam文件中MAPQ低于此值的read会被过滤
+    :param keep_dup: <bool>是否保留bam文件中标记为duplicate的read
+    :param cache_dir: read位点缓存目录, None表示不使用缓存
+    :param refresh_cache: <bool>忽略已有的缓存，重新解析read文件并覆盖缓存
+    :param regions: 需要的read位点范围{chrm: (starts, ends)}, 见read_regions
+    :param fetch_mode: bam文件的读取方式, 见BAM_FETCH_MODES
+    :param stream: <bool>是否逐条染色体读取按坐标排序的read文件
+    :return: 所有read记录的位点, {chrm: 升序的numpy数组}, 或者SortedReads
+    """
     if ".bed" in reads_fp:
-        return _get_reads_position(reads_fp, shift)
+        params = {}
     elif ".bam" in reads_fp:
-        return _get_bam_position(reads_fp,shift)
+        params = {'min_mapq': min_mapq, 'keep_dup': keep_dup}
     else:
         print "please get right read input"
-    
+        return None
+    if cache_dir is not None:
+        key = read_cache_key(reads_fp, shift, **params)
+        if refresh_cache:
+            remove_cached_reads(cache_dir, key)
+        else:
+            reads_pos = load_cached_reads(cache_dir, key)
+            if reads_pos is not None:
+                return reads_pos
+    use_regions = ".bam" in reads_fp and _use_region_fetch(reads_fp, regions, fetch_mode)
+    if stream:
+        return SortedReads(reads_fp, shift, threads, min_mapq, keep_dup, regions if use_regions else None)
+    if use_regions:
+        return _get_bam_region_position(reads_fp, shift, regions, threads, min_mapq, keep_dup)
+    if ".bed" in reads_fp:
+        reads_pos = _get_reads_position(reads_fp, shift)
+    else:
+        reads_pos = _get_bam_position(reads_fp, shift, threads, min_mapq, keep_dup)
+    if cache_dir is not None:
+        save_cached_reads(cache_dir, key, reads_pos)
+    return reads_pos
 
 
 def _read_peaks(peak_fp):
@@ -82,26 +457,21 @@ def _read_peaks(peak_fp):
     summit要求是相对于start的位置（和macs的结果一样）
     以#开头的行会跳过，列之间用制表符分隔开
     :param peak_fp: peak文件路径
-    :return: Peak的字典
+    :return: PeakTable
     """
-    pks = {}
+    chrms, starts, ends, summits = [], [], [], []
     with open(peak_fp) as fi:
         for li in fi:
             if li.startswith('#'):
                 continue
             sli = li.split('\t')
-            chrm = sli[0].strip()
+            chrm, start, end = sli[0].strip(), int(sli[1]), int(sli[2])
             try:
-                # pk = Peak(chrm, int(sli[1]), int(sli[2]))
-                pk = Peak(chrm, int(sli[1]), int(sli[2]), int(sli[3].strip()))
+                summit = start + int(sli[3].strip())
             except:
-                pk = Peak(chrm, int(sli[1]), int(sli[2]))
-            try:
-                pks[chrm].append(pk)
-            except KeyError:
-                pks[chrm] = []
-                pks[chrm].append(pk)
-    return pks
+                summit = (start + end) / 2 + 1
+            chrms.append(chrm), starts.append(start), ends.append(end), summits.append(summit)
+    return PeakTable.from_columns(chrms, starts, ends, summits)
 
 
 def _read_macs_xls_peaks(peak_fp):
@@ -129,9 +499,9 @@ def _read_macs_xls_peaks(peak_fp):
     chr1    761943  763542  1600    1306    204     373.20  10.53   8.45
     chr1    839510  840672  1163    449     77      69.35   5.60    100
     :param peak_fp: macs xls peaks file path
-    :return: peaks字典
+    :return: PeakTable
     """
-    pks = {}
+    chrms, starts, ends, summits = [], [], [], []
     with open(peak_fp) as fi:
         for li in fi:
             if li.startswith('#'):
@@ -139,16 +509,11 @@ def _read_macs_xls_peaks(peak_fp):
             sli = li.split('\t')
             chrm = sli[0].strip()
             try:
-                # pk = Peak(chrm, int(sli[1]), int(sli[2]))
-                pk = Peak(chrm, int(sli[1]), int(sli[2]), int(sli[4]))
+                start, end, summit = int(sli[1]), int(sli[2]), int(sli[1]) + int(sli[4])
             except:
                 continue
-            try:
-                pks[chrm].append(pk)
-            except KeyError:
-                pks[chrm] = []
-                pks[chrm].append(pk)
-    return pks
+            chrms.append(chrm), starts.append(start), ends.append(end), summits.append(summit)
+    return PeakTable.from_columns(chrms, starts, ends, summits)
 
 
 def read_peaks(peak_fp):
@@ -158,255 +523,257 @@ def read_peaks(peak_fp):
         return _read_peaks(peak_fp)
 
 
-def output_normalized_peaks(pks_unique, pks_common, file_name, rds1_name, rds2_name):
+def _format_column(fmt, values):
+    """
+    将一列数值按fmt格式化成字符串列表
+    """
+    return map(fmt.__mod__, values.tolist())
+
+
+def _join_rows(columns):
+    """
+    将格式化好的各列拼接成制表符分隔的文本，每行以换行符结尾
+    """
+    if len(columns[0]) == 0:
+        return ''
+    return '\n'.join(map('\t'.join, zip(*columns))) + '\n'
+
+
+def _open_output(file_name, compress=False):
+    """
+    打开输出文件，compress为True时写成gzip压缩文件并在文件名后加上.gz
+    """
+    if compress:
+        return gzip.open(file_name + '.gz', 'wb')
+    return open(file_name, 'w')
+
+
+def _normalized_peaks_header(rds1_name, rds2_name):
+    return '\t'.join(['chr', 'start', 'end', 'summit', 'M_value', 'A_value', 'P_value', 'Peak_Group',
+                      'normalized_read_density_in_%s' % rds1_name,
+                      'normalized_read_density_in_%s\n' % rds2_name])
+
+
+def _normalized_peaks_text(pks, group_name):
+    """
+    一组peaks的标准化结果文本
+    """
+    return _join_rows([pks.chrm_names().tolist(), _format_column('%d', pks.start), _format_column('%d', pks.end),
+                       _format_column('%d', pks.summit - pks.start), _format_column('%f', pks.normed_mvalue),
+                       _format_column('%f', pks.normed_avalue), _format_column('%s', pks.pvalue),
+                       [group_name] * len(pks), _format_column('%f', pks.normed_read_density1),
+                       _format_column('%f', pks.read_density2)])
+
+
+def output_normalized_peaks(pks_unique, pks_common, file_name, rds1_name, rds2_name, compress=False):
     """
     输出MAnorm标准化后的结果
+    :param compress: 是否写成gzip压缩文件
     """
-    fo = open(file_name, 'w')
-    # declaration = manorm_file_declaration
-    header = \
-        '\t'.join(['chr', 'start', 'end', 'summit', 'M_value', 'A_value', 'P_value', 'Peak_Group',
-                   'normalized_read_density_in_%s' % rds1_name,
-                   'normalized_read_density_in_%s\n' % rds2_name])
-    # fo.write(declaration)
-    fo.write(header)
-    for chrm in pks_unique.keys():
-        for pk in pks_unique[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), 'unique',
-                   pk.normed_read_density1, pk.read_density2,)
-            fo.write('\t'.join(
-                ['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    for chrm in pks_common.keys():
-        for pk in pks_common[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), 'common',
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(
-                ['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
+    fo = _open_output(file_name, compress)
+    fo.write(_normalized_peaks_header(rds1_name, rds2_name) +
+             _normalized_peaks_text(pks_unique, 'unique') + _normalized_peaks_text(pks_common, 'common'))
     fo.close()
 
 
 def output_3set_normalized_peaks(pks1_unique, merged_pks, pks2_unique, file_name, pks1_name,
-                                 pks2_name, rds1_name, rds2_name):
+                                 pks2_name, rds1_name, rds2_name, compress=False):
     """
     输出pks1_unique, pks2_unique, merged_pks所有的peaks
+    :param compress: 是否写成gzip压缩文件
+    """
+    fo = _open_output(file_name, compress)
+    fo.write(_normalized_peaks_header(rds1_name, rds2_name) +
+             _normalized_peaks_text(pks1_unique, '%s_unique' % pks1_name) +
+             _normalized_peaks_text(merged_pks, 'merged_common_peak') +
+             _normalized_peaks_text(pks2_unique, '%s_unique' % pks2_name))
+    fo.close()
+
+
+def normalized_peaks_columns(pks1_unique, merged_pks, pks2_unique, pks1_name, pks2_name, rds1_name, rds2_name):
+    """
+    所有peaks的M/A值表的各列，列与output_3set_normalized_peaks输出的表相同
+    :return: OrderedDict{列名: numpy数组}
+    """
+    tables = [pks1_unique, merged_pks, pks2_unique]
+    groups = ['%s_unique' % pks1_name, 'merged_common_peak', '%s_unique' % pks2_name]
+    return OrderedDict([
+        ('chr', np.concatenate([pks.chrm_names() for pks in tables]).astype(str)),
+        ('start', np.concatenate([pks.start for pks in tables])),
+        ('end', np.concatenate([pks.end for pks in tables])),
+        ('summit', np.concatenate([pks.summit - pks.start for pks in tables])),
+        ('M_value', np.concatenate([pks.normed_mvalue for pks in tables])),
+        ('A_value', np.concatenate([pks.normed_avalue for pks in tables])),
+        ('P_value', np.concatenate([pks.pvalue for pks in tables])),
+        ('Peak_Group', np.repeat(groups, [len(pks) for pks in tables])),
+        ('normalized_read_density_in_%s' % rds1_name, np.concatenate([pks.normed_read_density1 for pks in tables])),
+        ('normalized_read_density_in_%s' % rds2_name, np.concatenate([pks.read_density2 for pks in tables])),
+    ])
+
+
+def output_columnar_peaks(pks1_unique, merged_pks, pks2_unique, file_name, pks1_name, pks2_name,
+                          rds1_name, rds2_name, fmt='parquet'):
+    """
+    将所有peaks的M/A值表写成二进制列式文件，列与output_3set_normalized_peaks输出的表相同，数值不经过文本格式化
+    :param file_name: 输出文件名(不含扩展名)
+    :param fmt: parquet(需要安装pyarrow或fastparquet)或npz(numpy.load读取)
+    :return: 输出文件名
+    """
+    columns = normalized_peaks_columns(pks1_unique, merged_pks, pks2_unique, pks1_name, pks2_name,
+                                       rds1_name, rds2_name)
+    if fmt == 'parquet':
+        file_name += '.parquet'
+        pd.DataFrame(columns).to_parquet(file_name, index=False)
+    elif fmt == 'npz':
+        file_name += '.npz'
+        np.savez(file_name, **columns)
+    else:
+        raise ValueError('unknown columnar format: %s' % fmt)
+    return file_name
+
+
+def output_extension_sweep(rows, file_name):
+    """
+    输出多个延伸长度的比较报告，每个延伸长度一行
+    :param rows: 每个延伸长度的统计字典列表，键见EXTENSION_SWEEP_COLUMNS
+    """
+    with open(file_name, 'w') as fo:
+        fo.write('\t'.join(name for (name, fmt) in EXTENSION_SWEEP_COLUMNS) + '\n')
+        for row in rows:
+            fo.write('\t'.join(fmt % row[name] for (name, fmt) in EXTENSION_SWEEP_COLUMNS) + '\n')
+
+
+def read_chrom_sizes(chrom_sizes_fp):
+    """
+    读取染色体长度文件(如UCSC的hg19.chrom.sizes)，每行为染色体名和长度
+    :return: [(chrm, size)], 保持文件中的顺序
+    """
+    chrom_sizes = []
+    with open(chrom_sizes_fp) as fi:
+        for line in fi:
+            fields = line.split()
+            if len(fields) >= 2 and not line.startswith('#'):
+                chrom_sizes.append((fields[0], int(fields[1])))
+    return chrom_sizes
+
+
+def _track_intervals(summits, span=TRACK_SPAN, chrom_size=None):
+    """
+    一条染色体上按summit升序排列的peaks在轨迹中的区间：每个peak覆盖[summit - 1, summit - 1 + span)(0起始坐标)，
+    与下一个peak重叠的部分截掉，超出染色体长度的部分也截掉。summit相同的peaks只保留最后一个：前面的区间被截成
+    长度0后去掉(排序是稳定的，output_peaks_tracks中即pks1_unique, merged, pks2_unique里靠后的那个)
+    :return: (保留的peaks的下标, 区间start, 区间end)
+    """
+    starts = summits - 1
+    ends = starts + span
+    ends[:-1] = np.minimum(ends[:-1], starts[1:])
+    if chrom_size is not None:
+        ends = np.minimum(ends, chrom_size)
+    keep = np.flatnonzero((ends > starts) & (starts >= 0))
+    return keep, starts[keep], ends[keep]
+
+
+def _write_bigwig(file_name, chrom_sizes, sorted_peaks, values):
+    """
+    将排好序的peaks的一列数值写成bigWig文件，只输出chrom_sizes中有的染色体
+    """
+    import pyBigWig
+    bw = pyBigWig.open(file_name, 'w')
+    bw.addHeader(chrom_sizes)
+    for chrm, size in chrom_sizes:
+        lo, hi = sorted_peaks.chrm_range(chrm)
+        if hi == lo:
+            continue
+        keep, starts, ends = _track_intervals(sorted_peaks.summit[lo:hi], chrom_size=size)
+        if keep.size == 0:
+            continue
+        bw.addEntries([chrm] * keep.size, starts.tolist(), ends=ends.tolist(), values=values[lo:hi][keep].tolist())
+    bw.close()
+
+
+def output_peaks_tracks(pks1_uni, pks2_uni, merged_pks, comparison_name, chrom_sizes=None, compress=False,
+                        output_dir='.'):
+    """
+    输出所有peaks标准化后的M值和-log10(p-value)的bedGraph轨迹文件，给出染色体长度时同时输出带索引的bigWig文件
+    :param comparison_name: 轨迹名, 也是输出文件名的前缀
+    :param chrom_sizes: [(chrm, size)], 见read_chrom_sizes
+    :param compress: 是否将bedGraph写成gzip压缩文件
+    :param output_dir: 输出目录
+    """
+    print 'output track files ... '
+
+    sorted_peaks = _sort_peaks_list(PeakTable.concat([pks1_uni, merged_pks, pks2_uni]), 'summit')
+    tracks = [('Mvalues', comparison_name, sorted_peaks.normed_mvalue),
+              ('Pvalues', '%s(-log10(p-value))' % comparison_name, -sorted_peaks.log_pvalue / log(10))]
+    for (suffix, track_name, values) in tracks:
+        file_name = os.path.join(output_dir, '_'.join([comparison_name, 'peaks_%s' % suffix]))
+        fo = _open_output(file_name + '.bedGraph', compress)
+        fo.write('track type=bedGraph name=%s visibility=full autoScale=on color=255,0,0 '
+                 'yLineMark=0 yLineOnOff=on priority=10\n' % track_name)
+        for chrm in sorted_peaks.keys():
+            lo, hi = sorted_peaks.chrm_range(chrm)
+            keep, starts, ends = _track_intervals(sorted_peaks.summit[lo:hi])
+            fo.write(_join_rows([[chrm] * keep.size, _format_column('%d', starts), _format_column('%d', ends),
+                                 _format_column('%r', values[lo:hi][keep])]))
+        fo.close()
+        if chrom_sizes is not None:
+            _write_bigwig(file_name + '.bw', chrom_sizes, sorted_peaks, values)
+
+
+def _write_filtered_bed(file_name, pks, mask, name, compress=False):
+    """
+    将mask选中的peaks写成bed文件，第4列为from_<name>_<序号>，第5列为标准化后的M值
+    :return: 写出的peak数
     """
-    fo = open(file_name, 'w')
-    # declaration = manorm_file_declaration
-    header = '\t'.join(
-        ['chr', 'start', 'end', 'summit', 'M_value', 'A_value', 'P_value', 'Peak_Group',
-         'normalized_read_density_in_%s' % rds1_name,
-         'normalized_read_density_in_%s\n' % rds2_name])
-    # fo.write(declaration)
-    fo.write(header)
-    for chrm in pks1_unique.keys():
-        for pk in pks1_unique[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), '%s_unique' % pks1_name,
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(
-                ['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    for chrm in merged_pks.keys():
-        for pk in merged_pks[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), 'merged_common_peak',
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(
-                ['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
-    for chrm in pks2_unique.keys():
-        for pk in pks2_unique[chrm]:
-            cnt = (pk.chrm, pk.start, pk.end, pk.summit - pk.start,
-                   pk.normed_mvalue, pk.normed_avalue, str(pk.pvalue), '%s_unique' % pks2_name,
-                   pk.normed_read_density1, pk.read_density2)
-            fo.write('\t'.join(
-                ['%s', '%d', '%d', '%d', '%f', '%f', '%s', '%s', '%f', '%f']) % cnt + '\n')
+    idx = np.flatnonzero(mask)
+    fo = _open_output(file_name, compress)
+    fo.write(_join_rows([pks.chrm_names()[idx].tolist(), _format_column('%d', pks.start[idx]),
+                         _format_column('%d', pks.end[idx]),
+                         ['from_%s_%d' % (name, i) for i in xrange(1, idx.size + 1)],
+                         _format_column('%r', pks.normed_mvalue[idx])]))
     fo.close()
+    return idx.size
 
 
-def draw_figs_to_show_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name, ma_fit,
-                           reads1_name, reads2_name):
-    """
-    draw four figures to show data before and after rescaled
-    """
-    pks_3set = [pks1_uni, pks2_uni, merged_pks]
-    pks1_name = ' '.join([pks1_name, 'unique'])
-    pks2_name = ' '.join([pks2_name, 'unique'])
-    merged_pks_name = 'merged common peaks'
-    pks_names = [pks1_name, pks2_name, merged_pks_name]
-    colors = 'bgr'
-    a_max = 0
-    a_min = 10000
-    plt.figure(1).set_size_inches(16, 12)
-    for (idx, pks) in enumerate(pks_3set):
-        mvalues, avalues = get_peaks_mavalues(pks)
-        if len(avalues) != 0:
-            a_max = max(max(avalues), a_max)
-            a_min = min(min(avalues), a_min)
-        plt.scatter(avalues, mvalues, s=10, c=colors[idx])
-    plt.xlabel('A value')
-    plt.ylabel('M value')
-    plt.grid(axis='y')
-    plt.legend(pks_names, loc='best')
-    plt.title('before rescale')
-
-    # plot the fitting model into figure 1
-    x = np.arange(a_min, a_max, 0.01)
-    y = ma_fit[1] * x + ma_fit[0]
-    plt.plot(x, y, '-', color='k')
-    plt.savefig('before_rescale.png')
-
-    # plot the scatter plots of read count in merged common peaks between two chip-seq sets
-    plt.figure(2).set_size_inches(16, 12)
-    rd_min = 1000
-    rd_max = 0
-    rds_density1, rds_density2 = [], []
-    for key in merged_pks.keys():
-        for pk in merged_pks[key]:
-            rds_density1.append(pk.read_density1), rds_density2.append(pk.read_density2)
-    rd_max = max(max(log2(rds_density1)), rd_max)
-    rd_min = min(min(log2(rds_density1)), rd_min)
-    plt.scatter(log2(rds_density1), log2(rds_density2), s=10, c='r', label=merged_pks_name,
-                alpha=0.5)
-    plt.xlabel(' log2 read density' + ' by ' + '"' + reads1_name + '" reads')
-    plt.ylabel(' log2 read density' + ' by ' + '"' + reads2_name + '" reads')
-    plt.grid(axis='y')
-    plt.legend(loc='upper left')
-    plt.title('Fitting Model via common peaks')
-    rx = np.arange(rd_min, rd_max, 0.01)
-    ry = (2 - ma_fit[1]) * rx / (2 + ma_fit[1]) - 2 * ma_fit[0] / (2 + ma_fit[1])
-    plt.plot(rx, ry, '-', color='k')
-    plt.savefig('log2_read_density.png')
-
-    # plot the MA plot after rescale
-    plt.figure(3).set_size_inches(16, 12)
-    for (idx, pks) in enumerate(pks_3set):
-        normed_mvalues, normed_avalues = get_peaks_normed_mavalues(pks)
-        plt.scatter(normed_avalues, normed_mvalues, s=10, c=colors[idx])
-    plt.xlabel('A value')
-    plt.ylabel('M value')
-    plt.grid(axis='y')
-    plt.legend(pks_names, loc='best')
-    plt.title('after rescale')
-    plt.savefig('after_rescale.png')
-
-    # generate MA plot for this set of peaks together with p-value
-    plt.figure(4).set_size_inches(16, 12)
-    for (idx, pks) in enumerate(pks_3set):
-        normed_mvalues, normed_avalues = get_peaks_normed_mavalues(pks)
-        colors = -log10(get_peaks_pvalues(pks))
-        for i, c in enumerate(colors):
-            if c > 50:
-                colors[i] = 50
-        plt.scatter(normed_avalues, normed_mvalues, s=10, c=colors, cmap='jet')
-    plt.colorbar()
-    plt.grid(axis='y')
-    plt.xlabel('A value')
-    plt.ylabel('M value')
-    plt.title('-log10(P-value)')
-    plt.savefig('-log10_P-value.png')
-    plt.close()
-
-
-def output_peaks_mvalue_2wig_file(pks1_uni, pks2_uni, merged_pks, comparison_name):
-    """
-    output of peaks with normed m value and p values
-    """
-    print 'output wig files ... '
-
-    peaks = _add_peaks(_add_peaks(pks1_uni, merged_pks), pks2_uni)
-    f_2write = open('_'.join([comparison_name, 'peaks_Mvalues.wig']), 'w')
-    f_2write.write('browser position chr11:5220000-5330000\n')
-    f_2write.write('track type=wiggle_0 name=%s' % comparison_name +
-                   ' visibility=full autoScale=on color=255,0,0 ' +
-                   ' yLineMark=0 yLineOnOff=on priority=10\n')
-    for chr_id in peaks.keys():
-        f_2write.write('variableStep chrom=' + chr_id + ' span=100\n')
-        pks_chr = peaks[chr_id]
-        sorted_pks_chr = _sort_peaks_list(pks_chr, 'summit')
-        # write sorted peak summit and m-value to file
-        [f_2write.write('\t'.join(['%d' % pk.summit, '%s\n' % str(pk.normed_mvalue)])) for pk in
-         sorted_pks_chr]
-    f_2write.close()
-
-    f_2write = open('_'.join([comparison_name, 'peaks_Pvalues.wig']), 'w')
-    f_2write.write('browser position chr11:5220000-5330000\n')
-    f_2write.write('track type=wiggle_0 name=%s(-log10(p-value))' % comparison_name +
-                   ' visibility=full autoScale=on color=255,0,0 ' +
-                   ' yLineMark=0 yLineOnOff=on priority=10\n')
-    for chr_id in peaks.keys():
-        f_2write.write('variableStep chrom=' + chr_id + ' span=100\n')
-        pks_chr = peaks[chr_id]
-        sorted_pks_chr = _sort_peaks_list(pks_chr, 'summit')
-        # write sorted peak summit and m-value to file
-        [f_2write.write('\t'.join(['%d' % pk.summit, '%s\n' % str(-log10(pk.pvalue))])) for pk in
-         sorted_pks_chr]
-    f_2write.close()
-
-
-def output_unbiased_peaks(pks1_uni, pks2_uni, merged_pks, unbiased_mvalue, overlap_dependent):
+def output_unbiased_peaks(pks1_uni, pks2_uni, merged_pks, unbiased_mvalue, overlap_dependent, compress=False,
+                          output_dir='.'):
     """
     输出没有显著差异的peak
     """
     print 'define unbiased peaks: '
 
     if not overlap_dependent:
-        pks = _add_peaks(_add_peaks(pks1_uni, merged_pks), pks2_uni)
+        pks = PeakTable.concat([pks1_uni, merged_pks, pks2_uni])
         name = 'all_peaks'
     else:
         pks = merged_pks
         name = 'merged_common_peaks'
 
-    file_bed = open('unbiased_peaks_of_%s' % name + '.bed', 'w')
-    # file_bed.write(bed_peak_header)
-    i = 0
-    for key in pks.keys():
-        for pk in pks[key]:
-            if abs(pk.normed_mvalue) < unbiased_mvalue:
-                i += 1
-                line = '\t'.join([pk.chrm, '%d' % pk.start, '%d' % pk.end, 'from_%s_%d' % (name, i),
-                                  '%s\n' % str(pk.normed_mvalue)])
-                file_bed.write(line)
+    i = _write_filtered_bed(os.path.join(output_dir, 'unbiased_peaks_of_%s' % name + '.bed'), pks,
+                            np.abs(pks.normed_mvalue) < unbiased_mvalue, name, compress)
     print 'filter %d unbiased peaks' % i
-    file_bed.close()
 
 
 def output_biased_peaks(pks1_uni, pks2_uni, merged_pks, biased_mvalue, biased_pvalue,
-                        overlap_dependent):
+                        overlap_dependent, compress=False, output_dir='.'):
     """
     输出有显著差异的peaks
     """
     print 'define biased peaks:'
 
     if not overlap_dependent:
-        pks = _add_peaks(_add_peaks(pks1_uni, merged_pks), pks2_uni)
+        pks = PeakTable.concat([pks1_uni, merged_pks, pks2_uni])
         name = 'all_peaks'
     else:
-        pks = _add_peaks(pks1_uni, pks2_uni)
+        pks = PeakTable.concat([pks1_uni, pks2_uni])
         name = 'unique_peaks'
 
-    file_bed_over = open('M_over_%.2f_biased_peaks_of_%s' % (biased_mvalue, name) + '.bed', 'w')
-    # file_bed_over.write(bed_peak_header)
-    file_bed_less = open('M_less_-%.2f_biased_peaks_of_%s' % (biased_mvalue, name) + '.bed', 'w')
-    # file_bed_less.write(bed_peak_header)
-    i, j = 0, 0
-    for key in pks.keys():
-        for pk in pks[key]:
-            if pk.pvalue < biased_pvalue:
-                if pk.normed_mvalue > biased_mvalue:
-                    i += 1
-                    line = '\t'.join(
-                        [pk.chrm, '%d' % pk.start, '%d' % pk.end, 'from_%s_%d' % (name, i),
-                         '%s\n' % str(pk.normed_mvalue)])
-                    file_bed_over.write(line)
-                if pk.normed_mvalue < -biased_mvalue:
-                    j += 1
-                    line = '\t'.join(
-                        [pk.chrm, '%d' % pk.start, '%d' % pk.end, 'from_%s_%d' % (name, j),
-                         '%s\n' % str(pk.normed_mvalue)])
-                    file_bed_less.write(line)
+    significant = pks.pvalue < biased_pvalue
+    over_fp = os.path.join(output_dir, 'M_over_%.2f_biased_peaks_of_%s' % (biased_mvalue, name) + '.bed')
+    less_fp = os.path.join(output_dir, 'M_less_-%.2f_biased_peaks_of_%s' % (biased_mvalue, name) + '.bed')
+    i = _write_filtered_bed(over_fp, pks, significant & (pks.normed_mvalue > biased_mvalue), name, compress)
+    j = _write_filtered_bed(less_fp, pks, significant & (pks.normed_mvalue < -biased_mvalue), name, compress)
     print 'filter %d biased peaks' % (i + j)
-    file_bed_over.close(), file_bed_less.close()
 
 
 def test_read_reads():
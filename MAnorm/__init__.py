@@ -1 +1,3 @@
 __author__ = 'Semal'
+
+from pipeline import MAnormResult, run_manorm, write_results
@@ -1,10 +1,21 @@
 # coding=utf-8
 from bisect import bisect_left, bisect_right
 from math import log, exp
+from multiprocessing import Pool
 from scipy.misc import comb
-import random
+from scipy.special import gammaln, xlogy
 import numpy as np
-from statsmodels import api as sm
+
+from scheduler import map_chromosomes
+
+# 随机化测试中每批计算的矩阵元素个数上限，用来控制内存
+PERMUTATION_BATCH_ELEMENTS = 20000000
+# Huber稳健回归的参数，与statsmodels RLM的默认值(HuberT, MAD尺度, 按deviance判断收敛)一致
+HUBER_T = 1.345
+HUBER_TOL = 1e-8
+HUBER_MAXITER = 50
+# MAD尺度估计的正态一致性常数 norm.ppf(0.75)
+MAD_NORMAL_CONST = 0.6744897501960817
 
 
 class Peak(object):
@@ -80,6 +91,212 @@ class Peak(object):
             return False
 
 
+class PeakTable(object):
+    """
+    按列存储的peaks表。每一列是一个numpy数组，一行对应一个peak，不再为每个peak创建Peak对象。
+    行按染色体分组存放，第i条染色体(chrms[i])的peaks位于[offsets[i], offsets[i + 1])
+    """
+    int_columns = ('start', 'end', 'summit', 'read_count1', 'read_count2')
+    float_columns = ('read_density1', 'read_density2', 'normed_read_density1', 'mvalue', 'avalue',
+                     'normed_mvalue', 'normed_avalue', 'pvalue', 'log_pvalue')
+    columns = ('chrm', 'group') + int_columns + float_columns
+
+    def __init__(self, chrms, chrm, start, end, summit, group=None, group_labels=None, **values):
+        """
+        :param chrms: 染色体名列表，chrm列中的编号是这个列表的下标
+        :param chrm: 每个peak的染色体编号
+        :param start: peak的起始位置
+        :param end: peak的终止位置
+        :param summit: peak summit的绝对位置
+        :param group: 每个peak的分组编号，是group_labels的下标
+        :param group_labels: 分组名列表，如unique, common
+        :param values: 其它已经计算好的列(read_count1, mvalue等)
+        """
+        chrm = np.asarray(chrm, dtype=np.int32)
+        # 按染色体编号稳定排序，同一条染色体内保持原来的顺序
+        order = np.argsort(chrm, kind='mergesort')
+        self.chrms = list(chrms)
+        self.chrm = chrm[order]
+        self.start = np.asarray(start, dtype=np.int64)[order]
+        self.end = np.asarray(end, dtype=np.int64)[order]
+        self.summit = np.asarray(summit, dtype=np.int64)[order]
+        if group is None:
+            self.group = np.zeros(self.chrm.size, dtype=np.int8)
+        else:
+            self.group = np.asarray(group, dtype=np.int8)[order]
+        self.group_labels = list(group_labels) if group_labels is not None else []
+        for name in self.int_columns[3:]:
+            value = values.get(name)
+            setattr(self, name, np.zeros(self.chrm.size, dtype=np.int64) if value is None
+                    else np.asarray(value, dtype=np.int64)[order])
+        for name in self.float_columns:
+            value = values.get(name)
+            setattr(self, name, np.zeros(self.chrm.size, dtype=np.float64) if value is None
+                    else np.asarray(value, dtype=np.float64)[order])
+        counts = np.bincount(self.chrm, minlength=len(self.chrms))
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self._chrm_ids = dict((c, i) for (i, c) in enumerate(self.chrms))
+
+    @classmethod
+    def from_columns(cls, chrm_names, start, end, summit=None, group_label=None):
+        """
+        由每个peak的染色体名和位置创建PeakTable，染色体按第一次出现的顺序编号
+        :param chrm_names: 每个peak的染色体名
+        :param start: peak的起始位置
+        :param end: peak的终止位置
+        :param summit: peak summit的绝对位置，None时使用peak的中心
+        :param group_label: 所有peak的分组名
+        :return: PeakTable
+        """
+        start, end = np.asarray(start, dtype=np.int64), np.asarray(end, dtype=np.int64)
+        if summit is None:
+            summit = (start + end) // 2 + 1
+        if len(chrm_names) == 0:
+            chrms, chrm = [], np.zeros(0, dtype=np.int32)
+        else:
+            names, first, inverse = np.unique(np.asarray(chrm_names), return_index=True, return_inverse=True)
+            rank = np.argsort(first)
+            remap = np.empty(rank.size, dtype=np.int32)
+            remap[rank] = np.arange(rank.size)
+            chrms, chrm = [str(names[i]) for i in rank], remap[inverse]
+        return cls(chrms, chrm, start, end, summit,
+                   group_labels=[group_label] if group_label is not None else None)
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        合并多个PeakTable，染色体和分组名取并集，同一条染色体内按tables的顺序排列
+        """
+        chrms, group_labels = [], []
+        for table in tables:
+            chrms += [c for c in table.chrms if c not in chrms]
+            group_labels += [g for g in table.group_labels if g not in group_labels]
+        chrm, group = [], []
+        for table in tables:
+            chrm_map = np.array([chrms.index(c) for c in table.chrms] or [0], dtype=np.int32)
+            group_map = np.array([group_labels.index(g) for g in table.group_labels] or [0], dtype=np.int8)
+            chrm.append(chrm_map[table.chrm])
+            group.append(group_map[table.group])
+        values = dict((name, np.concatenate([getattr(t, name) for t in tables]))
+                      for name in cls.int_columns + cls.float_columns)
+        return cls(chrms, np.concatenate(chrm), group=np.concatenate(group), group_labels=group_labels,
+                   **values)
+
+    def __len__(self):
+        return self.chrm.size
+
+    def keys(self):
+        """
+        有peak的染色体名，与原来peaks字典的keys()对应
+        """
+        return [c for (i, c) in enumerate(self.chrms) if self.offsets[i + 1] > self.offsets[i]]
+
+    def chrm_range(self, chrm):
+        """
+        染色体chrm上的peaks在表中的行范围[lo, hi)
+        """
+        i = self._chrm_ids.get(chrm)
+        if i is None:
+            return 0, 0
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def chrm_size(self, chrm):
+        """
+        染色体chrm上的peak个数
+        """
+        lo, hi = self.chrm_range(chrm)
+        return hi - lo
+
+    def chrm_names(self):
+        """
+        每个peak的染色体名
+        """
+        return np.array(self.chrms, dtype=object)[self.chrm] if self.chrms else np.zeros(0, dtype=object)
+
+    def group_names(self):
+        """
+        每个peak的分组名
+        """
+        if not self.group_labels:
+            return np.zeros(len(self), dtype=object)
+        return np.array(self.group_labels, dtype=object)[self.group]
+
+    def set_group(self, label):
+        """
+        把所有peak设为同一个分组
+        """
+        self.group_labels = [label]
+        self.group[:] = 0
+        return self
+
+    def take(self, idx):
+        """
+        取出idx指定的行组成新的PeakTable
+        """
+        values = dict((name, getattr(self, name)[idx]) for name in self.int_columns + self.float_columns)
+        return PeakTable(self.chrms, self.chrm[idx], group=self.group[idx], group_labels=self.group_labels,
+                         **values)
+
+    def subset(self, mask):
+        """
+        取出mask为True的行组成新的PeakTable
+        """
+        return self.take(np.flatnonzero(mask))
+
+    def sort_by(self, column):
+        """
+        每条染色体内按column列排序
+        """
+        return self.take(np.lexsort((getattr(self, column), self.chrm)))
+
+    def peak(self, idx):
+        """
+        第idx个peak的视图
+        """
+        return PeakView(self, idx)
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield PeakView(self, idx)
+
+    def __getitem__(self, chrm):
+        """
+        兼容原来的peaks字典: pks[chrm]返回该染色体上peaks的视图列表
+        """
+        lo, hi = self.chrm_range(chrm)
+        return [PeakView(self, idx) for idx in xrange(lo, hi)]
+
+
+class PeakView(object):
+    """
+    PeakTable中一行的视图，提供和Peak一样的属性，读写都直接作用于PeakTable的列
+    """
+    __slots__ = ('_table', '_idx')
+
+    def __init__(self, table, idx):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_idx', idx)
+
+    def __getattr__(self, name):
+        if name == 'chrm':
+            return self._table.chrms[self._table.chrm[self._idx]]
+        if name in PeakTable.int_columns or name in PeakTable.float_columns:
+            return getattr(self._table, name)[self._idx]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in PeakTable.int_columns or name in PeakTable.float_columns:
+            getattr(self._table, name)[self._idx] = value
+        else:
+            raise AttributeError(name)
+
+    def set_summit(self, smt):
+        self.summit = smt
+
+    def isoverlap(self, other_pk):
+        return Peak.isoverlap.__func__(self, other_pk)
+
+
 def _digit_exprs_p_norm(x, y):
     """
     利用read count相对于随机情况下计算p值
@@ -100,179 +317,520 @@ def _digit_exprs_p_norm(x, y):
         return p
 
 
+def _py2_round(x):
+    """
+    与python2的round一致的取整(.5时远离0)，x为非负数
+    """
+    floor_x = np.floor(x)
+    return floor_x + (x - floor_x >= 0.5)
+
+
+def _digit_exprs_p_norm_array(x, y):
+    """
+    _digit_exprs_p_norm的向量化版本，对整个数组一次计算p值。
+    x + y < 20时用精确的组合数(由gammaln计算后取整), 否则用近似公式, log p不低于-500
+    :param x: 标准化后的read density 1数组
+    :param y: read density 2数组
+    :return: (p值数组, p值的自然对数数组)
+    """
+    xx = _py2_round(np.asarray(x, dtype=np.float64))
+    xx[xx == 0] = 1
+    yy = _py2_round(np.asarray(y, dtype=np.float64))
+    n = xx + yy
+    pvalues, log_pvalues = np.empty(n.shape), np.empty(n.shape)
+
+    small = n < 20.0  # if x + y small
+    n_s, xx_s, yy_s = n[small], xx[small], yy[small]
+    comb_s = np.round(np.exp(gammaln(n_s + 1) - gammaln(xx_s + 1) - gammaln(yy_s + 1)))
+    pvalues[small] = comb_s * 2 ** -(n_s + 1.0)
+    log_pvalues[small] = np.log(comb_s) - (n_s + 1.0) * log(2.0)
+
+    large = ~small  # if x + y large, use the approximate equations
+    n_l, xx_l, yy_l = n[large], xx[large], yy[large]
+    log_p = xlogy(n_l, n_l) - xlogy(xx_l, xx_l) - xlogy(yy_l, yy_l) - (n_l + 1.0) * log(2.0)
+    log_p = np.maximum(log_p, -500)
+    pvalues[large] = np.exp(log_p)
+    log_pvalues[large] = log_p
+    return pvalues, log_pvalues
+
+
 def get_peaks_size(pks):
     """
-    获取peaks字典的数据长度
+    获取peaks表的数据长度
     """
-    i = 0
-    for key in pks.keys():
-        for _ in pks[key]:
-            i += 1
-    return i
+    return len(pks)
+
+
+def _count_reads_in_windows(reads_pos_chrm, summits, ext):
+    """
+    一次searchsorted计算同一条染色体上所有以summit为中心的窗口内的read数。
+    窗口是闭区间[summit - ext - 1, summit + ext]，与Peak.__cal_read_count的计数结果一致。
+    ext是数组时所有延伸长度的窗口边界也在同一次searchsorted里完成
+    :param reads_pos_chrm: 该染色体上升序排列的read位点数组
+    :param summits: 该染色体上peaks的summit数组
+    :param ext: 窗口从summit左右扩展的长度，或者多个长度的数组
+    :return: 每个窗口内的read数, ext是数组时为len(ext) x len(summits)的矩阵
+    """
+    summits = np.asarray(summits, dtype=np.int64)
+    exts = np.asarray(ext, dtype=np.int64)
+    n = summits.size * max(1, exts.size)
+    # 整数坐标下 bisect_right(x) == bisect_left(x + 1)，左右边界可以合并到一次searchsorted里
+    edges = np.concatenate(((summits - exts[..., None] - 1).ravel(), (summits + exts[..., None] + 1).ravel()))
+    # 边界转换成read数组的类型，避免searchsorted为了统一类型复制整个read数组
+    dtype_info = np.iinfo(reads_pos_chrm.dtype)
+    edges = np.clip(edges, dtype_info.min, dtype_info.max).astype(reads_pos_chrm.dtype)
+    if exts.ndim == 0:
+        idx = np.searchsorted(reads_pos_chrm, edges, side='left')
+    else:
+        # 多个延伸长度的边界排成一个升序序列再查找，相邻的查找落在read数组的相近位置，缓存命中率更高
+        order = np.argsort(edges, kind='mergesort')
+        idx = np.empty(edges.size, dtype=np.intp)
+        idx[order] = np.searchsorted(reads_pos_chrm, edges[order], side='left')
+    return (idx[n:] - idx[:n]).reshape(exts.shape + summits.shape)
+
+
+def _count_chrm_reads(chrm, tables, reads_pos1, reads_pos2, ext):
+    """
+    计算多个peaks表在一条染色体上所有窗口内两组reads的read数，summit相同的窗口只计数一次
+    :return: (reads1的read数, reads2的read数), 按tables的顺序拼接; 染色体上没有read时为None
+    """
+    summits = np.concatenate([pks.summit[slice(*pks.chrm_range(chrm))] for pks in tables])
+    unique_summits, inverse = np.unique(summits, return_inverse=True)
+    return tuple(_count_reads_in_windows(reads_pos[chrm], unique_summits, ext)[..., inverse]
+                 if chrm in reads_pos else None for reads_pos in (reads_pos1, reads_pos2))
+
+
+def _count_streamed_reads(tables, reads_stream, chrms, ext):
+    """
+    逐条染色体读取reads(如SortedReads)并计算多个peaks表中所有窗口内的read数，
+    每条染色体的read位点计数后就释放，内存中只有一条染色体的reads
+    :param reads_stream: 有iter_chromosomes(chrms)方法的对象，逐条返回(chrm, 升序的read位点数组)
+    :param chrms: 有peaks的染色体
+    :return: 每个表的read数数组列表
+    """
+    counts = [np.zeros(np.shape(ext) + (len(pks),), dtype=np.int64) for pks in tables]
+    for (chrm, reads_pos_chrm) in reads_stream.iter_chromosomes(chrms):
+        ranges = [pks.chrm_range(chrm) for pks in tables]
+        summits = np.concatenate([pks.summit[lo:hi] for (pks, (lo, hi)) in zip(tables, ranges)])
+        unique_summits, inverse = np.unique(summits, return_inverse=True)
+        chrm_counts = _count_reads_in_windows(reads_pos_chrm, unique_summits, ext)[..., inverse]
+        del reads_pos_chrm
+        offset = 0
+        for (count, (lo, hi)) in zip(counts, ranges):
+            # 文件没有排序时同一条染色体可能再返回一次完整的结果，直接覆盖
+            count[..., lo:hi] = chrm_counts[..., offset:offset + hi - lo]
+            offset += hi - lo
+    return counts
+
+
+def _count_tables_reads(tables, reads_pos1, reads_pos2, ext, processes=1):
+    """
+    计算多个peaks表中所有窗口内两组reads的read数，各条染色体可以分给多个进程
+    :param tables: PeakTable列表
+    :param reads_pos1, reads_pos2: {chrm: 升序的read位点数组}，或者逐条染色体读取的SortedReads
+    :param ext: 窗口从summit左右扩展的长度，或者多个长度的数组
+    :param processes: 进程数
+    :return: (reads1的read数数组列表, reads2的read数数组列表), 每个表一个数组(ext是数组时为len(ext)行的矩阵)
+    """
+    chrms = []
+    for pks in tables:
+        chrms += [chrm for chrm in pks.keys() if chrm not in chrms]
+    if hasattr(reads_pos1, 'iter_chromosomes') or hasattr(reads_pos2, 'iter_chromosomes'):
+        # 两组reads分别逐条染色体计数
+        return tuple(_count_streamed_reads(tables, reads_pos, chrms, ext) if hasattr(reads_pos, 'iter_chromosomes')
+                     else _count_tables_reads(tables, reads_pos, {}, ext, processes)[0]
+                     for reads_pos in (reads_pos1, reads_pos2))
+    counts1 = [np.zeros(np.shape(ext) + (len(pks),), dtype=np.int64) for pks in tables]
+    counts2 = [np.zeros(np.shape(ext) + (len(pks),), dtype=np.int64) for pks in tables]
+    chrms = [chrm for chrm in chrms if chrm in reads_pos1 or chrm in reads_pos2]
+    weights = [sum(pks.chrm_size(chrm) for pks in tables) for chrm in chrms]
+    results = map_chromosomes(_count_chrm_reads, chrms, weights, processes, tables=tables,
+                              reads_pos1=reads_pos1, reads_pos2=reads_pos2, ext=ext)
+    for chrm in chrms:
+        ranges = [pks.chrm_range(chrm) for pks in tables]
+        for (counts, chrm_counts) in zip((counts1, counts2), results[chrm]):
+            if chrm_counts is None:
+                continue
+            offset = 0
+            for (count, (lo, hi)) in zip(counts, ranges):
+                count[..., lo:hi] = chrm_counts[..., offset:offset + hi - lo]
+                offset += hi - lo
+    return counts1, counts2
+
+
+def _log2(values):
+    return np.log(values) / log(2)
+
+
+def cal_peak_tables_read_density(tables, reads_pos1, reads_pos2, ext, processes=1):
+    """
+    一次计算多个peaks表(如pks1 unique, pks2 unique和merged peaks)的read count, read density以及M值和A值。
+    所有表中相同的窗口只计数一次，结果直接写入各表的列中
+    :param tables: PeakTable列表
+    :param reads_pos1: read文件1的位点字典, {chrm: 升序的numpy数组}, 或者逐条染色体读取的SortedReads
+    :param reads_pos2: read文件2的位点字典或SortedReads
+    :param ext: 窗口从summit左右扩展的长度
+    :param processes: 按染色体并行计数的进程数
+    """
+    counts1, counts2 = _count_tables_reads(tables, reads_pos1, reads_pos2, ext, processes)
+    set_peak_tables_read_density(tables, counts1, counts2, ext)
+
+
+def count_peak_tables_reads(tables, reads_pos1, reads_pos2, exts, processes=1):
+    """
+    一次计算多个延伸长度下所有窗口内的read数: 每条染色体的所有窗口边界只做一次searchsorted，
+    耗时与单个延伸长度接近
+    :param tables: PeakTable列表
+    :param reads_pos1, reads_pos2: read位点字典或SortedReads
+    :param exts: 延伸长度列表
+    :param processes: 按染色体并行计数的进程数
+    :return: (reads1的read数矩阵列表, reads2的read数矩阵列表), 每个表一个len(exts) x len(pks)的矩阵
+    """
+    return _count_tables_reads(tables, reads_pos1, reads_pos2, np.asarray(exts, dtype=np.int64), processes)
+
+
+def set_peak_tables_read_density(tables, counts1, counts2, ext):
+    """
+    由窗口内的read数计算read density以及M值和A值，写入各表的列中
+    :param counts1, counts2: 每个表的read数数组列表
+    :param ext: 计数窗口的延伸长度
+    """
+    for (pks, count1, count2) in zip(tables, counts1, counts2):
+        # 加1是为了保证每个peak的read count初始为1
+        pks.read_count1[:], pks.read_count2[:] = count1 + 1, count2 + 1
+        pks.read_density1[:] = pks.read_count1 * 1000. / (2. * ext)
+        pks.read_density2[:] = pks.read_count2 * 1000. / (2. * ext)
+        log2_density1, log2_density2 = _log2(pks.read_density1), _log2(pks.read_density2)
+        pks.mvalue[:] = log2_density1 - log2_density2
+        pks.avalue[:] = (log2_density1 + log2_density2) / 2
 
 
 def cal_peaks_read_density(pks, reads_pos1, reads_pos2, ext):
     """
-    计算pks字典中所有peak的read density
-    :param pks: pks字典
+    计算peaks表中所有peak的read density以及M值和A值
+    :param pks: PeakTable
+    :param reads_pos1: read文件1的位点字典, {chrm: 升序的numpy数组}
+    :param reads_pos2: read文件2的位点字典
+    :param ext: 窗口从summit左右扩展的长度
     """
-    for key in pks.keys():
-        [pk.cal_read_density(reads_pos1, reads_pos2, ext) for pk in pks[key]]
+    cal_peak_tables_read_density([pks], reads_pos1, reads_pos2, ext)
 
 
 def normalize_peaks(pks, ma_fit):
     """
-    :param pks: peaks字典
+    :param pks: PeakTable
     :param ma_fit: 用来标准化peaks的M值和A值的模型参数
     """
-    for key in pks.keys():
-        [pk.normalize_mavalue(ma_fit) for pk in pks[key]]
+    log2_density1, log2_density2 = _log2(pks.read_density1), _log2(pks.read_density2)
+    # key method for normalizing read density
+    normed_log2_density1 = \
+        (2. - ma_fit[1]) * log2_density1 / (2. + ma_fit[1]) - 2. * ma_fit[0] / (2. + ma_fit[1])
+    pks.normed_read_density1[:] = 2 ** normed_log2_density1
+    pks.normed_mvalue[:] = normed_log2_density1 - log2_density2
+    pks.normed_avalue[:] = (normed_log2_density1 + log2_density2) / 2.
+    pks.pvalue[:], pks.log_pvalue[:] = _digit_exprs_p_norm_array(pks.normed_read_density1, pks.read_density2)
 
 
-def get_common_peaks(pks1, pks2):
+def normalize_peak_tables(tables, ma_fit):
+    """
+    用同一个模型标准化多个peaks表
+    :param tables: PeakTable列表
+    :param ma_fit: 用来标准化peaks的M值和A值的模型参数
+    """
+    for pks in tables:
+        normalize_peaks(pks, ma_fit)
+
+
+def get_common_peaks(pks1, pks2, processes=1):
     """
     通过看两组peaks之间是否有重复区域找出pks1与pks2共有的peak
-    :param pks1: pks1字典
-    :param pks2: pks2字典
+    :param pks1: pks1表
+    :param pks2: pks2表
+    :param processes: 按染色体并行的进程数
     :return: common and unique peaks
     """
-    pks1_unique, pks1_common, pks2_unique, pks2_common = {}, {}, {}, {}
-    common_chrm = set(pks1.keys()).intersection(pks2.keys())
-    pks1_unique_chrm, pks2_unique_chrm = \
-        set(pks1.keys()).difference(common_chrm), set(pks2.keys()).difference(common_chrm)
-    for chrm in pks1_unique_chrm:
-        pks1_unique[chrm] = pks1[chrm]
-    for chrm in pks2_unique_chrm:
-        pks2_unique[chrm] = pks2[chrm]
-    for chrm in common_chrm:
-        pks1_unique[chrm], pks1_common[chrm], pks2_unique[chrm], pks2_common[chrm] = \
-            __get_common_peaks(pks1[chrm], pks2[chrm])
-    return pks1_unique, pks1_common, pks2_unique, pks2_common
+    flag1, flag2 = np.zeros(len(pks1), dtype=bool), np.zeros(len(pks2), dtype=bool)
+    chrms = [chrm for chrm in pks1.keys() if pks2.chrm_size(chrm) > 0]
+    weights = [pks1.chrm_size(chrm) + pks2.chrm_size(chrm) for chrm in chrms]
+    results = map_chromosomes(_common_peaks_chrm, chrms, weights, processes, pks1=pks1, pks2=pks2)
+    for chrm in chrms:
+        flag1[slice(*pks1.chrm_range(chrm))], flag2[slice(*pks2.chrm_range(chrm))] = results[chrm]
+    return pks1.subset(~flag1), pks1.subset(flag1), pks2.subset(~flag2), pks2.subset(flag2)
+
+
+def _common_peaks_chrm(chrm, pks1, pks2):
+    lo1, hi1 = pks1.chrm_range(chrm)
+    lo2, hi2 = pks2.chrm_range(chrm)
+    return __get_common_peaks(pks1.start[lo1:hi1], pks1.end[lo1:hi1], pks2.start[lo2:hi2], pks2.end[lo2:hi2])
 
 
-def __get_common_peaks(pks1_chrm, pks2_chrm):
+def __get_common_peaks(starts1, ends1, starts2, ends2):
     """
     两组peaks同一条染色体中peaks内找common peaks
-    :param pks1_chrm: pks1的chri染色体上的peaks
-    :param pks2_chrm: pks2的chri染色体上的peaks
-    :return: common and unique peaks
+    :param starts1, ends1: pks1的chri染色体上peaks的起止位置
+    :param starts2, ends2: pks2的chri染色体上peaks的起止位置
+    :return: pks1和pks2中每个peak是否为common peak
     """
-    flag1, flag2 = np.zeros(len(pks1_chrm)), np.zeros(len(pks2_chrm))
-    pks2_chrm_start = np.array([pk.start for pk in pks2_chrm])
-    pks2_chrm_end = np.array([pk.end for pk in pks2_chrm])
-    for i, pk in enumerate(pks1_chrm):
-        claus = 1.0 * (pk.end - pks2_chrm_start) * (pks2_chrm_end - pk.start)
-        overlap_locs = np.where(claus > 0)[0]
-        if overlap_locs.size > 0:
-            flag1[i] = 1
-            flag2[overlap_locs] = 1
+    return _overlap_flags(starts1, ends1, starts2, ends2), _overlap_flags(starts2, ends2, starts1, ends1)
 
-    pks1_chrm_unique, pks1_chrm_common = [], []
-    for i, v in enumerate(flag1):
-        pks1_chrm_unique.append(pks1_chrm[i]) if v == 0 else pks1_chrm_common.append(pks1_chrm[i])
 
-    pks2_chrm_unique, pks2_chrm_common = [], []
-    for i, v in enumerate(flag2):
-        pks2_chrm_unique.append(pks2_chrm[i]) if v == 0 else pks2_chrm_common.append(pks2_chrm[i])
+def _overlap_flags(starts, ends, other_starts, other_ends):
+    """
+    判断每个区间是否与other中的任一区间重叠，复杂度O((n + m) log m)。
+    重叠的定义与原来的 (end - other_start) * (other_end - start) > 0 一致，
+    对start <= end的区间等价于 other_start < end 且 other_end > start:
+    把other按start排序后，start小于end的是一个前缀，只要这个前缀中最大的end大于start就有重叠
+    :param starts, ends: 需要判断的区间
+    :param other_starts, other_ends: 另一组区间
+    :return: 每个区间是否有重叠的bool数组
+    """
+    flag = np.zeros(starts.size, dtype=bool)
+    if other_starts.size == 0:
+        return flag
+    order = np.argsort(other_starts, kind='mergesort')
+    sorted_other_starts = other_starts[order]
+    prefix_max_ends = np.maximum.accumulate(other_ends[order])
+    # 每个区间之前(other_start < end)的other区间个数
+    n_before = np.searchsorted(sorted_other_starts, ends, side='left')
+    has_before = n_before > 0
+    flag[has_before] = prefix_max_ends[n_before[has_before] - 1] > starts[has_before]
+    return flag
+
+
+def _randomize_range(pks):
+    """
+    随机化时每个peak起始位置的取值范围: 所在染色体上peaks的[min_start, max_end]
+    :return: 每个peak的下界和上界数组
+    """
+    low, high = np.zeros(len(pks), dtype=np.int64), np.zeros(len(pks), dtype=np.int64)
+    for key in pks.keys():
+        lo, hi = pks.chrm_range(key)
+        low[lo:hi], high[lo:hi] = pks.start[lo:hi].min(), pks.end[lo:hi].max()
+    return low, high
 
-    return pks1_chrm_unique, pks1_chrm_common, pks2_chrm_unique, pks2_chrm_common
 
+def _random_starts(low, high, rng):
+    """
+    在[low, high]内为每个peak均匀随机生成一个起始位置(与random.randint一样包含两端)
+    """
+    starts = low + np.floor(rng.random_sample(low.size) * (high - low + 1)).astype(np.int64)
+    return np.minimum(starts, high)
 
-def randomize_peaks(pks):
+
+def randomize_peaks(pks, rng=None):
     """
     通过随机模拟出和pks类似的random_pks
     :param pks: 被模拟的peaks
+    :param rng: numpy.random.RandomState, None时使用numpy的全局随机数生成器
     :return: 模拟后的peaks
     """
-    randomized_pks = {}
-    for key in pks.keys():
-        randomized_pks[key] = []
-        pks_chrm = pks[key]
-        starts, ends = [pk.start for pk in pks_chrm], [pk.end for pk in pks_chrm]
-        lengths = [e - s for e, s in zip(ends, starts)]
-        min_start, max_end = min(starts), max(ends)
-        for length in lengths:
-            randomized_start = random.randint(min_start, max_end)
-            randomized_pks[key].append(Peak(key, randomized_start, randomized_start + length))
-    return randomized_pks
+    low, high = _randomize_range(pks)
+    randomized_starts = _random_starts(low, high, rng if rng is not None else np.random)
+    randomized_ends = randomized_starts + (pks.end - pks.start)
+    return PeakTable(pks.chrms, pks.chrm, randomized_starts, randomized_ends,
+                     (randomized_starts + randomized_ends) // 2 + 1)
+
+
+def _batch_overlap_counts(starts, ends, other_starts, other_ends):
+    """
+    _overlap_flags的批量版本: other是B组随机区间(B x m的矩阵)，一次计算每组中与other重叠的区间个数。
+    各组排序后加上互不相交的偏移量拼成一个升序数组，所有组的查询只需要一次searchsorted
+    :param starts, ends: 需要判断的区间(长度n)
+    :param other_starts, other_ends: B x m的区间矩阵
+    :return: 长度为B的数组, 每组中有重叠的区间个数
+    """
+    n_batch, m = other_starts.shape
+    if m == 0 or starts.size == 0:
+        return np.zeros(n_batch, dtype=np.int64)
+    rows = np.arange(n_batch)[:, None]
+    order = np.argsort(other_starts, axis=1, kind='mergesort')
+    sorted_other_starts = other_starts[rows, order]
+    prefix_max_ends = np.maximum.accumulate(other_ends[rows, order], axis=1)
+    base = min(starts.min(), sorted_other_starts[:, 0].min())
+    span = max(ends.max(), other_ends.max()) - base + 1
+    row_offsets = np.arange(n_batch, dtype=np.int64)[:, None] * span
+    flat_other_starts = (sorted_other_starts - base + row_offsets).ravel()
+    queries = (ends[None, :] - base + row_offsets).ravel()
+    n_before = np.searchsorted(flat_other_starts, queries, side='left').reshape(n_batch, starts.size)
+    n_before -= rows * m
+    flag = n_before > 0
+    last = (n_before + rows * m - 1)[flag]
+    flag[flag] = prefix_max_ends.ravel()[last] > np.broadcast_to(starts, flag.shape)[flag]
+    return flag.sum(axis=1)
+
+
+def _random_overlap_counts(pks1, pks2, seed, perm_ids):
+    """
+    计算一批随机化的pks2与pks1之间的common peak数。每次随机化使用独立的种子(seed, perm_id)，
+    结果与如何分批、用多少个进程无关
+    :return: 每次随机化时pks1中common peak的个数
+    """
+    low, high = _randomize_range(pks2)
+    random_starts = np.vstack([_random_starts(low, high, np.random.RandomState([seed, perm_id]))
+                               for perm_id in perm_ids])
+    random_ends = random_starts + (pks2.end - pks2.start)
+    counts = np.zeros(len(perm_ids), dtype=np.int64)
+    for chrm in set(pks1.keys()).intersection(pks2.keys()):
+        lo1, hi1 = pks1.chrm_range(chrm)
+        lo2, hi2 = pks2.chrm_range(chrm)
+        counts += _batch_overlap_counts(pks1.start[lo1:hi1], pks1.end[lo1:hi1],
+                                        random_starts[:, lo2:hi2], random_ends[:, lo2:hi2])
+    return counts
+
+
+_permutation_pks = {}
+
+
+def _init_permutation_worker(pks1, pks2):
+    _permutation_pks['pks1'], _permutation_pks['pks2'] = pks1, pks2
+
+
+def _random_overlap_counts_worker(args):
+    seed, perm_ids = args
+    return _random_overlap_counts(_permutation_pks['pks1'], _permutation_pks['pks2'], seed, perm_ids)
+
+
+def random_overlap_test(pks1, pks2, random_time, seed=None, processes=1):
+    """
+    随机化pks2的位置random_time次，统计每次随机化后pks1中common peak的个数。
+    所有随机化分批向量化计算，批次可以分给多个进程
+    :param pks1: pks1表
+    :param pks2: 被随机化的pks2表
+    :param random_time: 随机化次数
+    :param seed: 随机种子, None时随机选取
+    :param processes: 进程数
+    :return: (使用的种子, 每次随机化的common peak数数组)
+    """
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+    # 每批的矩阵元素个数不超过PERMUTATION_BATCH_ELEMENTS，并保证每个进程都能分到批次
+    batch_size = max(1, min(PERMUTATION_BATCH_ELEMENTS // max(1, len(pks1) + len(pks2)),
+                            -(-random_time // max(1, processes))))
+    tasks = [(seed, range(i, min(i + batch_size, random_time))) for i in xrange(0, random_time, batch_size)]
+    if processes <= 1 or len(tasks) <= 1:
+        counts = [_random_overlap_counts(pks1, pks2, task_seed, perm_ids) for (task_seed, perm_ids) in tasks]
+    else:
+        pool = Pool(min(processes, len(tasks)), _init_permutation_worker, (pks1, pks2))
+        try:
+            counts = pool.map(_random_overlap_counts_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return seed, np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
 
 
-def merge_common_peaks(pks1_common, pks2_common):
+def summarize_random_overlap(n_common, random_counts):
+    """
+    总结随机化测试的结果
+    :param n_common: 实际的common peak数
+    :param random_counts: 每次随机化的common peak数
+    :return: 字典, 包括fold change的均值和标准差、经验p值以及随机分布的统计量
+    """
+    random_counts = np.asarray(random_counts, dtype=np.float64)
+    fcs = 1. * n_common / (random_counts + 0.1)  # 加0.1避免出现分母为零的情况
+    return {
+        'fold_change_mean': fcs.mean() if fcs.size else np.nan,
+        'fold_change_std': fcs.std() if fcs.size else np.nan,
+        # 随机情况下common peak数不小于实际值的比例(加1校正)
+        'empirical_pvalue': (1. + (random_counts >= n_common).sum()) / (random_counts.size + 1.),
+        'null_mean': random_counts.mean() if random_counts.size else np.nan,
+        'null_std': random_counts.std() if random_counts.size else np.nan,
+        'null_min': random_counts.min() if random_counts.size else np.nan,
+        'null_median': np.median(random_counts) if random_counts.size else np.nan,
+        'null_max': random_counts.max() if random_counts.size else np.nan,
+    }
+
+
+def merge_common_peaks(pks1_common, pks2_common, processes=1):
     """
     合并common peaks
+    :param processes: 按染色体并行的进程数
+    :return: 合并后的peaks表, 每个合并后peak的summit间距数组
     """
-    merged_pks = {}
-    summit_dist = {}
-    for key in pks1_common.keys():
-        mix_pks_chrm = pks1_common[key] + pks2_common[key]
-        merged_pks[key], summit_dist[key] = __merge_sorted_peaks_list(_sort_peaks_list(mix_pks_chrm))
-    return merged_pks, summit_dist
+    mixed_pks = _sort_peaks_list(_add_peaks(pks1_common, pks2_common), 'start')
+    common_chrms = set(pks1_common.keys()).intersection(pks2_common.keys())
+    keys = [key for key in mixed_pks.keys() if key in common_chrms]
+    results = map_chromosomes(_merge_chrm_peaks, keys, [mixed_pks.chrm_size(key) for key in keys],
+                              processes, mixed_pks=mixed_pks)
+    chrm, starts, ends, summits, summit_dist = [], [], [], [], []
+    for key in keys:
+        m_starts, m_ends, smt_a, smt_b, smt_dist = results[key]
+        chrm.append(np.repeat(mixed_pks.chrm[mixed_pks.chrm_range(key)[0]], m_starts.size))
+        starts.append(m_starts), ends.append(m_ends), summit_dist.append(smt_dist)
+        summits.append((smt_a + smt_b) // 2 + 1)
+    if not chrm:
+        return PeakTable(mixed_pks.chrms, [], [], [], []), np.zeros(0, dtype=np.int64)
+    merged_pks = PeakTable(mixed_pks.chrms, np.concatenate(chrm), np.concatenate(starts), np.concatenate(ends),
+                           np.concatenate(summits))
+    return merged_pks, np.concatenate(summit_dist)
+
 
+def _merge_chrm_peaks(chrm, mixed_pks):
+    lo, hi = mixed_pks.chrm_range(chrm)
+    return _merge_sorted_intervals(mixed_pks.start[lo:hi], mixed_pks.end[lo:hi], mixed_pks.summit[lo:hi])[1:]
 
-def _sort_peaks_list(pks_list, start_or_summit='start'):
+
+def _sort_peaks_list(pks, start_or_summit='start'):
     """
-    将peaks列表进行排序
+    将peaks表在每条染色体内进行排序
     """
     if start_or_summit == 'start':
-        return [pks_list[loc] for loc in np.argsort([pk.start for pk in pks_list])]
+        return pks.sort_by('start')
     elif start_or_summit == 'summit':
-        return [pks_list[loc] for loc in np.argsort([pk.summit for pk in pks_list])]
+        return pks.sort_by('summit')
 
 
 def _add_peaks(pks1, pks2):
     """
-    将peaks中对应的key的值扩展
-    :param pks1: peaks1字典
-    :param pks2: peaks2字典
-    :return: 新的peaks字典
+    将两个peaks表合并
+    :param pks1: peaks1表
+    :param pks2: peaks2表
+    :return: 新的peaks表
     """
-    peaks = {}
-    keys = set(pks1.keys() + pks2.keys())
-    for key in keys:
-        value = []
-        if key in pks1.keys():
-            value += pks1[key]
-        if key in pks2.keys():
-            value += pks2[key]
-        peaks[key] = value
-    return peaks
-
-
-def __merge_sorted_peaks_list(sorted_pks_list):
-    # print 'sorted peaks length: %d' % len(sorted_pks_list)
-    merged_pks, smt_dists = [], []
-
-    def get_a_merged_peak(head_loc):
-        # print head_loc
-        merged_pk_num = 0
-        merged_pk = sorted_pks_list[head_loc]
-        summits = [merged_pk.summit]
-        for pk in sorted_pks_list[head_loc + 1:]:
-            if merged_pk.isoverlap(pk):
-                merged_pk = Peak(pk.chrm, min(merged_pk.start, pk.start), max(merged_pk.end, pk.end))
-                summits.append(pk.summit)
-                merged_pk_num += 1
-            else:
-                # print summits
-                sorted_summits = sorted(summits)
-                smt_a, smt_b = get_summit(sorted_summits)
-                smt_dist = smt_b - smt_a
-                merged_pk.set_summit((smt_a + smt_b) / 2 + 1)
-                new_head_loc = head_loc + merged_pk_num + 1
-                return new_head_loc, merged_pk, smt_dist
-        sorted_summits = sorted(summits)
-        smt_a, smt_b = get_summit(sorted_summits)
-        smt_dist = smt_b - smt_a
-        merged_pk.set_summit((smt_a + smt_b) / 2 + 1)
-        new_head_loc = head_loc + merged_pk_num + 1
-        return new_head_loc, merged_pk, smt_dist
-
-    h_loc = 0
-    while h_loc < len(sorted_pks_list):
-        h_loc, m_pk, smt_d = get_a_merged_peak(h_loc)
-        merged_pks.append(m_pk)
-        smt_dists.append(smt_d)
-    return merged_pks, smt_dists
+    return PeakTable.concat([pks1, pks2])
+
+
+def _merge_sorted_intervals(starts, ends, summits):
+    """
+    一次遍历合并一条染色体上按start排好序的peaks，合并规则与Peak.isoverlap一致:
+    peak与当前合并区间[m_start, m_end)满足 m_start <= start < m_end 或 m_start < end <= m_end 时并入。
+    按start排序后当前合并区间的m_end就是之前所有peak end的累计最大值，因此只有start == end == m_end
+    的零长度peak需要额外比较m_start。
+    每个合并区间中summit排序后取相邻间距最大的一对(与get_summit相同)
+    :param starts, ends, summits: 按start升序排列的peaks
+    :return: (每个合并区间在输入中的起始下标, 合并区间的start, end, 选出的summit对smt_a, smt_b, summit间距)
+    """
+    n = starts.size
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty, empty, empty
+    idx = np.arange(n)
+    prev_max_ends = np.empty(n, dtype=np.int64)
+    prev_max_ends[0] = np.iinfo(np.int64).min
+    prev_max_ends[1:] = np.maximum.accumulate(ends)[:-1]
+    is_head = starts >= prev_max_ends
+    # 零长度且正好落在m_end上的peak, 是否并入取决于所在合并区间的m_start
+    on_edge = is_head & (ends == prev_max_ends) & (idx > 0)
+    head_idx = np.maximum.accumulate(np.where(is_head & ~on_edge, idx, 0))
+    is_head &= ~(on_edge & (ends > starts[head_idx]))
+    heads = np.flatnonzero(is_head)
+    merged_starts = starts[heads]
+    merged_ends = np.maximum.reduceat(ends, heads)
+
+    # 每个合并区间内summit排序, 找出相邻summit间距最大的第一对
+    cluster = np.cumsum(is_head) - 1
+    sorted_summits = summits[np.lexsort((summits, cluster))]
+    smt_a, smt_b = sorted_summits[heads].copy(), sorted_summits[heads].copy()
+    same_cluster = cluster[1:] == cluster[:-1]
+    pair_idx = np.flatnonzero(same_cluster)
+    if pair_idx.size > 0:
+        gaps = sorted_summits[pair_idx + 1] - sorted_summits[pair_idx]
+        pair_cluster = cluster[pair_idx]
+        order = np.lexsort((pair_idx, -gaps, pair_cluster))
+        first = np.flatnonzero(np.r_[True, pair_cluster[order][1:] != pair_cluster[order][:-1]])
+        best = pair_idx[order[first]]
+        smt_a[cluster[best]], smt_b[cluster[best]] = sorted_summits[best], sorted_summits[best + 1]
+    return heads, merged_starts, merged_ends, smt_a, smt_b, smt_b - smt_a
 
 
 def get_summit(sorted_summits):
@@ -284,65 +842,175 @@ def get_summit(sorted_summits):
     return smt_a, smt_b
 
 
-def use_merged_peaks_fit_model(merged_pks, summit_dist, min_summit_dist):
+def _weighted_median(values, weights):
+    """
+    加权中位数，权重全相同时等价于np.median
+    """
+    order = np.argsort(values, kind='mergesort')
+    values, cum_weights = values[order], np.cumsum(weights[order])
+    half = cum_weights[-1] / 2.
+    lo = np.searchsorted(cum_weights, half, side='left')
+    if cum_weights[lo] == half and lo + 1 < values.size:
+        return (values[lo] + values[lo + 1]) / 2.
+    return values[lo]
+
+
+def _mad_scale(resid, weights=None):
+    if weights is None:
+        return np.median(np.abs(resid)) / MAD_NORMAL_CONST
+    return _weighted_median(np.abs(resid), weights) / MAD_NORMAL_CONST
+
+
+def _wls_line(x, y, weights):
+    """
+    加权最小二乘拟合直线 y = b0 + b1 * x
+    :return: (b0, b1)
+    """
+    w_sum = weights.sum()
+    x_mean, y_mean = np.dot(weights, x) / w_sum, np.dot(weights, y) / w_sum
+    dx = x - x_mean
+    sxx = np.dot(weights, dx * dx)
+    b1 = np.dot(weights, dx * (y - y_mean)) / sxx if sxx > 0 else 0.
+    return y_mean - b1 * x_mean, b1
+
+
+def _huber_rho(z, t):
+    abs_z = np.abs(z)
+    return np.where(abs_z <= t, 0.5 * z * z, abs_z * t - 0.5 * t * t)
+
+
+def huber_fit(x, y, weights=None, t=HUBER_T, tol=HUBER_TOL, maxiter=HUBER_MAXITER):
+    """
+    迭代重加权最小二乘(IRLS)拟合Huber稳健回归直线 y = b0 + b1 * x。
+    迭代过程与statsmodels的RLM(y, add_constant(x)).fit()相同：从最小二乘解开始，每次迭代用
+    MAD(中心为0)估计残差尺度，权重为min(1, t / |残差/尺度|)，deviance的变化不超过tol或达到maxiter时停止
+    :param x: A值数组
+    :param y: M值数组
+    :param weights: 每个点的先验权重(如分箱后每个箱内的点数)，默认全为1
+    :return: (params, info), params为numpy数组[b0, b1]; info为字典，包括iterations, converged, scale, n_points
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    n = x.size
+    if n < 3:
+        raise ValueError('at least 3 points are needed to fit the model, got %d' % n)
+    prior = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    def deviance(b0, b1, w):
+        # 与RLM相同, 用加权残差平方和/(n-2)作为deviance的尺度
+        resid = y - (b0 + b1 * x)
+        wls_scale = np.dot(w, resid * resid) / (n - 2)
+        if wls_scale <= 0:
+            return 0., resid
+        return _huber_rho(resid / wls_scale, t).sum(), resid
+
+    b0, b1 = _wls_line(x, y, prior)
+    dev, resid = deviance(b0, b1, prior)
+    scale = _mad_scale(resid, weights)
+    iteration, converged = 1, False
+    while True:
+        abs_z = np.abs(resid / scale) if scale > 0 else np.zeros(n)
+        w = prior * np.where(abs_z <= t, 1., t / np.maximum(abs_z, t))
+        b0, b1 = _wls_line(x, y, w)
+        prev_dev = dev
+        dev, resid = deviance(b0, b1, w)
+        scale = _mad_scale(resid, weights)
+        iteration += 1
+        converged = abs(dev - prev_dev) <= tol
+        if converged or iteration >= maxiter:
+            break
+    info = {'iterations': iteration, 'converged': converged, 'scale': scale, 'n_points': n}
+    return np.array([b0, b1]), info
+
+
+def _stratified_subsample(x, size, rng):
+    """
+    按A值分层抽样：将点按A值排序后等分成size层，每层随机取一个点
+    :return: 选中点的下标
+    """
+    order = np.argsort(x, kind='mergesort')
+    edges = np.linspace(0, x.size, size + 1).astype(np.int64)
+    picks = edges[:-1] + (rng.random_sample(size) * (edges[1:] - edges[:-1])).astype(np.int64)
+    return order[picks]
+
+
+def _avalue_bins(x, y, bins):
+    """
+    将点按A值等分成bins个箱，每个箱用A值和M值的中位数代表
+    :return: (每箱A值中位数, 每箱M值中位数, 每箱的点数)
+    """
+    order = np.argsort(x, kind='mergesort')
+    edges = np.unique(np.linspace(0, x.size, bins + 1).astype(np.int64))
+    starts, counts = edges[:-1], np.diff(edges)
+    bin_ids = np.repeat(np.arange(starts.size), counts)
+    x_sorted = x[order]
+    y_sorted = y[order][np.lexsort((y[order], bin_ids))]
+    lo, hi = starts + (counts - 1) // 2, starts + counts // 2
+    return (x_sorted[lo] + x_sorted[hi]) / 2., (y_sorted[lo] + y_sorted[hi]) / 2., counts
+
+
+def use_merged_peaks_fit_model(merged_pks, summit_dist, min_summit_dist, fit_sample=None, fit_bins=None,
+                               seed=None):
     """
     利用合并后的peaks来拟合模型
+    :param merged_pks: 合并后的peaks表
+    :param summit_dist: 每个合并peak的summit间距数组
+    :param min_summit_dist: 只用summit间距不大于此值的peaks拟合
+    :param fit_sample: 用于拟合的点多于此值时，按A值分层抽取这么多个点拟合
+    :param fit_bins: 将用于拟合的点按A值等分成这么多个箱，用每箱的中位数(以点数为权重)拟合
+    :param seed: 分层抽样的随机数种子
+    :return: (ma_fit, fit_info), ma_fit为[截距, 斜率]; fit_info为拟合过程的信息(见huber_fit), 另有mode和n_selected
     """
-    selected_pks = {}
-    for key in merged_pks.keys():
-        selected_pks[key] = []
-        for pk, smt_d in zip(merged_pks[key], summit_dist[key]):
-            if smt_d <= min_summit_dist:
-                selected_pks[key].append(pk)
-    mvalues, avalues = get_peaks_mavalues(selected_pks)
-    fit_x = np.array(avalues)
-    fit_y = np.array(mvalues)
+    selected = summit_dist <= min_summit_dist
+    fit_x = merged_pks.avalue[selected]
+    fit_y = merged_pks.mvalue[selected]
     idx_sel = np.where((fit_y >= -10) & (fit_y <= 10))[0]
+    x, y = fit_x[idx_sel], fit_y[idx_sel]
 
     # fit the model
-    x = sm.add_constant(fit_x[idx_sel])
-    y = fit_y[idx_sel]
-    ma_fit = sm.RLM(y, x).fit().params
-    return ma_fit
+    mode, weights = 'all', None
+    if fit_bins is not None and x.size > fit_bins:
+        mode = 'bins'
+        x, y, weights = _avalue_bins(x, y, fit_bins)
+    elif fit_sample is not None and x.size > fit_sample:
+        mode = 'subsample'
+        idx = _stratified_subsample(x, fit_sample, np.random.RandomState(seed))
+        x, y = x[idx], y[idx]
+    ma_fit, fit_info = huber_fit(x, y, weights)
+    fit_info['mode'], fit_info['n_selected'] = mode, idx_sel.size
+    return ma_fit, fit_info
 
 
 def get_peaks_mavalues(pks):
     """
     返回peaks所有的m, a值对
-    :param pks: peaks字典
+    :param pks: peaks表
     :return: mvalues, avalues
     """
-    mvalues, avalues = [], []
-    for key in pks.keys():
-        for pk in pks[key]:
-            mvalues.append(pk.mvalue), avalues.append(pk.avalue)
-
-    return mvalues, avalues
+    return pks.mvalue, pks.avalue
 
 
 def get_peaks_normed_mavalues(pks):
     """
     返回peaks normalization之后所有的m, a值对
-    :param pks: peaks字典
+    :param pks: peaks表
     :return: normed_mvalues, normed_avalues
     """
-    normed_mvalues, normed_avalues = [], []
-    for key in pks.keys():
-        for pk in pks[key]:
-            normed_mvalues.append(pk.normed_mvalue), normed_avalues.append(pk.normed_avalue)
-
-    return normed_mvalues, normed_avalues
+    return pks.normed_mvalue, pks.normed_avalue
 
 
 def get_peaks_pvalues(pks):
     """
     返回peaks normalization之后所有的p值
-    :param pks: peaks字典
+    :param pks: peaks表
     :return: pvalues
     """
-    pvalues = []
-    for key in pks.keys():
-        for pk in pks[key]:
-            pvalues.append(pk.pvalue)
+    return pks.pvalue
+
 
-    return pvalues
\ No newline at end of file
+def get_peaks_log_pvalues(pks):
+    """
+    返回peaks normalization之后所有p值的自然对数，画图和输出-log10(p)时不会下溢
+    :param pks: peaks表
+    :return: log pvalues
+    """
+    return pks.log_pvalue
@@ -0,0 +1,489 @@
+# coding=utf-8
+# 一次两样本比较的完整流程：run_manorm完成第1步到第6步并返回结果对象，write_results输出第7步的各种文件，
+# 单次比较(bin/MAnorm)、多样本批量比较(bin/MAnorm_batch)和其它python程序共用
+import os
+
+from MAnorm_io import BAM_FETCH_MODES, COLUMNAR_FORMATS, read_peaks, read_reads, read_regions, \
+    output_normalized_peaks, output_3set_normalized_peaks, output_columnar_peaks, output_peaks_tracks, \
+    output_unbiased_peaks, output_biased_peaks, normalized_peaks_columns, output_extension_sweep
+from peaks import get_peaks_size, get_common_peaks, random_overlap_test, summarize_random_overlap, \
+    merge_common_peaks, cal_peak_tables_read_density, count_peak_tables_reads, set_peak_tables_read_density, \
+    use_merged_peaks_fit_model, normalize_peak_tables
+from plots import draw_figs_to_show_data, start_drawing_figs
+from profiling import StageProfiler
+from read_cache import default_cache_dir, CACHE_DIR_ENV
+
+import numpy as np
+
+
+def add_read_options(opt_parser):
+    """
+    读取read文件的选项
+    """
+    opt_parser.add_option('--mapq', dest='min_mapq', type='int', default=0,
+                          help='skip BAM reads with mapping quality lower than this value, default=0.')
+    opt_parser.add_option('--keep-dup', dest='keep_dup', action='store_true', default=False,
+                          help='keep BAM reads flagged as PCR/optical duplicates. Unmapped, secondary and '
+                               'supplementary alignments are always skipped.')
+    opt_parser.add_option('--cache-dir', dest='cache_dir', default=default_cache_dir(),
+                          help='folder of the on-disk reads cache. Parsed and sorted read positions are '
+                               'stored there and memory-mapped by later runs on the same reads file and '
+                               'shift, default=$%s (no cache if unset).' % CACHE_DIR_ENV)
+    opt_parser.add_option('--refresh-cache', dest='refresh_cache', action='store_true', default=False,
+                          help='ignore cached read positions, parse the reads files again and rewrite the cache.')
+    opt_parser.add_option('--stream-reads', dest='stream_reads', action='store_true', default=False,
+                          help='for coordinate-sorted reads files: do not load all reads, count them one chromosome '
+                               'at a time so that only the reads of one chromosome are in memory. Unsorted files '
+                               'are detected and loaded completely.')
+    opt_parser.add_option('--bam-fetch', dest='bam_fetch', type='choice', choices=BAM_FETCH_MODES, default='auto',
+                          help='how indexed BAM reads files are read: "regions" fetches only the reads around '
+                               'the peaks through the BAM index, "genome" loads all reads, "auto" fetches '
+                               'regions when the peak windows cover a small part of the genome, default=auto.')
+
+
+def add_comparison_options(opt_parser):
+    """
+    两样本比较的分析和输出选项，对应compare_samples的参数(见comparison_params)
+    """
+    opt_parser.add_option('-n', dest='random_time', type='int', default=5,
+                          help='number of random permutations to test the enrichment of '
+                               'overlapping between two peak sets, default=5.')
+    opt_parser.add_option('--seed', dest='seed', type='int',
+                          help='random seed of the permutations, so that the overlapping test can be '
+                               'reproduced. A random seed is chosen and printed if not given.')
+    opt_parser.add_option('-e', dest='extension', type='int', default=1000,
+                          help='default=1000, 2*extension=size of the window centered at peak '
+                               'summit to calculate reads density. The window size should match '
+                               'the typical length of peaks, thus we recommend extension=1000 '
+                               'for sharp histone marks like H3K4me2/3 or H3K9/27ac, '
+                               'extension=500 for transcription factor or DNase-seq.')
+    opt_parser.add_option('-d', dest='smt_dist', type='int',
+                          help='summit to summit distance cutoff, default=extension/2. '
+                               'Only those common peaks with distance between their summits in '
+                               '2 samples smaller than this value will be considered as real '
+                               'common peaks for building the normalization model.')
+    opt_parser.add_option('--sweep-ext', dest='sweep_exts',
+                          help='comma separated list of extensions to compare, e.g. 250,500,1000,2000. The reads '
+                               'of all window sizes are counted in one pass, the model is fitted for each '
+                               'extension and compared in <output>_extension_sweep.xls; the other outputs use -e. '
+                               'The summit distance cutoff is -d if given, otherwise half of each extension.')
+    opt_parser.add_option('--fit-sample', dest='fit_sample', type='int',
+                          help='fit the normalization model on a sample of this many common peaks, stratified '
+                               'by A-value, when more common peaks are available. Uses --seed.')
+    opt_parser.add_option('--fit-bins', dest='fit_bins', type='int',
+                          help='split the common peaks into this many A-value bins of equal size and fit the '
+                               'normalization model on the bin medians weighted by bin size.')
+    opt_parser.add_option('-s', dest='output_no_merge', action='store_true', default=False,
+                          help='By default, MAnorm will first separate both sets of input peaks '
+                               'into common and unique peaks, by checking whether they have overlap '
+                               'with any peak in the other sample, and then merge the 2 sets of '
+                               'common peaks into 1 group of non-overlapping ones. But if this option '
+                               'is used, MAnorm would not merge the common peaks and the peaks in '
+                               'output files will be exactly the same as those from input.')
+    opt_parser.add_option('-v', dest='overlap_dependent', action='store_true', default=False,
+                          help='if this option is used, MAnorm will choose biased peaks only from unique peaks, and '
+                               'choose unbiased peaks only from common peaks. But if this option is not used, MAnorm '
+                               'will choose biased and unbiased peaks just based on the M-value and P-value cutoffs, '
+                               'without checking whether they are common or unique peaks.')
+    opt_parser.add_option('-p', dest='biased_p', type='float', default=0.01,
+                          help='Cutoff of P-value to define biased (high-confidence sample 1 or 2-specific) peaks, '
+                               'default=0.01.')
+    opt_parser.add_option('-m', dest='biased_m', type='float', default=1.,
+                          help='Cutoff of M-value to define biased peaks, default=1. Sample 1 biased peaks are defined '
+                               'as sample 1 unique peaks with M-value > mcut_biased and P-value < pcut_biased, while '
+                               'sample 2 biased peaks are defined as sample 2 unique peaks with '
+                               'M-value < -1*mcut_biased and P-value < pcut_biased.')
+    opt_parser.add_option('-u', dest='unbiased_m', type='float', default=1.,
+                          help='Cutoff of M-value to define unbiased (high-confidence non-specific) peaks'
+                               'between 2 samples, default=1. They are defined to be the common peaks with'
+                               ' -1*mcut_unbiased < M-value < mcut_unbiased and P-value > pcut_biased.')
+    opt_parser.add_option('--gzip', dest='compress', action='store_true', default=False,
+                          help='write the peak tables (.xls) and the filtered peaks (.bed) gzip compressed.')
+    opt_parser.add_option('--columnar', dest='columnar', type='choice', choices=list(COLUMNAR_FORMATS),
+                          help='also write the M/A values of all peaks as a binary columnar file: parquet '
+                               '(needs pyarrow or fastparquet) or npz (read with numpy.load).')
+    opt_parser.add_option('--chrom-sizes', dest='chrom_sizes',
+                          help='chromosome sizes file (chromosome name and length per line, e.g. hg19.chrom.sizes). '
+                               'If given, the M-value and P-value tracks are also written as indexed bigWig '
+                               'files (needs pyBigWig).')
+    opt_parser.add_option('--no-figures', dest='no_figures', action='store_true', default=False,
+                          help='do not draw the figures (matplotlib is not needed then). By default the figures '
+                               'are drawn in a background process while the tables are written.')
+
+
+def comparison_params(values, chrom_sizes=None):
+    """
+    将add_comparison_options添加的选项转换成compare_samples的参数
+    :param chrom_sizes: 已经读取的染色体长度(见read_chrom_sizes)
+    """
+    return {
+        'ext': values.extension,
+        'min_smt_dist': values.smt_dist if values.smt_dist is not None else values.extension / 2,
+        'sweep_exts': [int(e) for e in values.sweep_exts.split(',')] if values.sweep_exts else None,
+        'sweep_min_smt_dist': values.smt_dist,
+        'random_time': values.random_time,
+        'seed': values.seed,
+        'fit_sample': values.fit_sample,
+        'fit_bins': values.fit_bins,
+        'output_no_merge': values.output_no_merge,
+        'overlap_dependent': values.overlap_dependent,
+        'biased_pvalue': values.biased_p,
+        'biased_mvalue': values.biased_m,
+        'unbiased_mvalue': values.unbiased_m,
+        'compress': values.compress,
+        'columnar': values.columnar,
+        'chrom_sizes': chrom_sizes,
+        'figures': not values.no_figures,
+    }
+
+
+def file_label(fp):
+    """
+    输出中代表输入文件的名字: 去掉路径和扩展名，空格换成下划线
+    """
+    return os.path.basename(fp).split('.')[0].replace(' ', '_')
+
+
+def reads_extension(ext, sweep_exts=None):
+    """
+    读取reads时窗口需要的延伸长度：同时比较多个延伸长度时取其中最大的，否则较大延伸长度的read数会缺少窗口外的reads
+    :param ext: 窗口从summit左右扩展的长度
+    :param sweep_exts: 需要比较的多个延伸长度，没有时为None
+    """
+    return max([ext] + list(sweep_exts or []))
+
+
+def load_peaks(peaks_fp, profiler=None, label=''):
+    """
+    读取一个样本的peaks
+    :param profiler: 记录读取步骤的StageProfiler
+    :param label: 读取步骤名的后缀
+    :return: peaks表
+    """
+    profiler = profiler or StageProfiler()
+    with profiler.stage('read_peaks' + label) as counts:
+        pks = read_peaks(peaks_fp)
+        counts['peaks'] = get_peaks_size(pks)
+    return pks
+
+
+def load_reads(reads_fp, shift, profiler=None, label='', threads=1, min_mapq=0, keep_dup=False, cache_dir=None,
+               refresh_cache=False, regions=None, bam_fetch='auto', stream_reads=False):
+    """
+    读取一个样本的reads
+    :param regions: 需要的read位点范围(见read_regions)，有索引的bam文件可以只读取这些范围
+    :param bam_fetch: bam文件的读取方式(见BAM_FETCH_MODES)
+    :param stream_reads: 是否在计算read数时才逐条染色体读取(见SortedReads)
+    :return: {chrm: read位点数组}, 或者SortedReads
+    """
+    profiler = profiler or StageProfiler()
+    with profiler.stage('read_reads' + label) as counts:
+        reads_pos = read_reads(reads_fp, shift, threads, min_mapq, keep_dup, cache_dir, refresh_cache, regions,
+                               bam_fetch, stream_reads)
+        if isinstance(reads_pos, dict):
+            counts['reads'] = sum(pos.size for pos in reads_pos.values())
+        else:
+            counts['streamed'] = True
+    return reads_pos
+
+
+def load_sample(peaks_fp, reads_fp, shift, profiler=None, label='', **read_options):
+    """
+    读取一个样本的peaks和reads
+    :param read_options: load_reads的其它参数
+    :return: (peaks表, {chrm: read位点数组})
+    """
+    return load_peaks(peaks_fp, profiler, label), load_reads(reads_fp, shift, profiler, label, **read_options)
+
+
+class MAnormResult(object):
+    """
+    一次两样本比较(第1步到第6步)的结果，peaks的各项数值都保存在PeakTable的列(numpy数组)中:
+        pks1_unique, pks1_common, pks2_unique, pks2_common: 两个样本的unique/common peaks
+        merged_pks: 合并后的common peaks, summit_dist: 每个合并peak的summit间距
+        ma_fit: 标准化模型[截距, 斜率], fit_info: 拟合过程的信息(见huber_fit)
+        seed, random_counts, overlap_stats: 随机化测试的种子、每次随机的common peak数和统计摘要
+        pks1_name, pks2_name, rds1_name, rds2_name: 输出中peaks和reads的名字
+        extension_sweep: 比较多个延伸长度时每个长度的统计(见EXTENSION_SWEEP_COLUMNS), 否则为None
+    """
+
+    def __init__(self, pks1_unique, pks1_common, pks2_unique, pks2_common, merged_pks, summit_dist, ma_fit,
+                 fit_info, seed, random_counts, overlap_stats, pks1_name, pks2_name, rds1_name, rds2_name,
+                 extension_sweep=None):
+        self.pks1_unique, self.pks1_common = pks1_unique, pks1_common
+        self.pks2_unique, self.pks2_common = pks2_unique, pks2_common
+        self.merged_pks, self.summit_dist = merged_pks, summit_dist
+        self.ma_fit, self.fit_info = ma_fit, fit_info
+        self.seed, self.random_counts, self.overlap_stats = seed, random_counts, overlap_stats
+        self.pks1_name, self.pks2_name, self.rds1_name, self.rds2_name = pks1_name, pks2_name, rds1_name, rds2_name
+        self.extension_sweep = extension_sweep
+
+    def columns(self):
+        """
+        所有peaks(两个样本的unique peaks和合并后的common peaks)的M/A值表
+        :return: OrderedDict{列名: numpy数组}, 列与*_all_peak_MAvalues.xls相同
+        """
+        return normalized_peaks_columns(self.pks1_unique, self.merged_pks, self.pks2_unique, self.pks1_name,
+                                        self.pks2_name, self.rds1_name, self.rds2_name)
+
+    def summary(self):
+        """
+        :return: 字典, 包括ma_fit, fit_info, seed, overlap_stats, extension_sweep和各组peaks的个数
+        """
+        return {
+            'ma_fit': list(self.ma_fit),
+            'fit_info': self.fit_info,
+            'seed': self.seed,
+            'overlap_stats': self.overlap_stats,
+            'extension_sweep': self.extension_sweep,
+            'peaks': {'unique1': get_peaks_size(self.pks1_unique), 'common1': get_peaks_size(self.pks1_common),
+                      'unique2': get_peaks_size(self.pks2_unique), 'common2': get_peaks_size(self.pks2_common),
+                      'merged_common': get_peaks_size(self.merged_pks)},
+        }
+
+
+def _say(verbose, message):
+    if verbose:
+        print message
+
+
+def _extension_stats(ext, min_smt_dist, ma_fit, fit_info, pks1_uniq, pks2_uniq, merged_pks):
+    """
+    一个延伸长度下标准化结果的统计，用于比较不同的延伸长度
+    """
+    def mean(values):
+        return values.mean() if values.size else np.nan
+    corr = np.corrcoef(np.log2(merged_pks.read_density1), np.log2(merged_pks.read_density2))[0, 1] \
+        if get_peaks_size(merged_pks) > 1 else np.nan
+    return {
+        'extension': ext,
+        'min_summit_dist': min_smt_dist,
+        'fit_points': fit_info['n_points'],
+        'slope': ma_fit[1],
+        'intercept': ma_fit[0],
+        'fit_scale': fit_info['scale'],
+        'converged': fit_info['converged'],
+        'common_M_sd': merged_pks.normed_mvalue.std(),
+        'unique1_M_mean': mean(pks1_uniq.normed_mvalue),
+        'unique2_M_mean': mean(pks2_uniq.normed_mvalue),
+        'log2_read_density_corr': corr,
+    }
+
+
+def run_manorm(pks1, pks2, reads_pos1, reads_pos2, shift1=100, shift2=100, ext=1000, min_smt_dist=None,
+               random_time=5, seed=None, fit_sample=None, fit_bins=None, output_no_merge=False, processes=1,
+               names=None, profiler=None, verbose=False, sweep_exts=None, sweep_min_smt_dist=None):
+    """
+    比较两个样本：peaks分类、随机化测试、合并common peaks、计算read密度、拟合并标准化，不输出任何文件
+    :param pks1, pks2: 两个样本的peaks表或peaks文件路径
+    :param reads_pos1, reads_pos2: 两个样本的read位点{chrm: 升序数组}或read文件路径
+    :param shift1, shift2: 给出read文件路径时读取使用的平移量, 有索引的bam文件按需只读取peaks附近的reads
+    :param ext: 计算read密度时summit向两边延伸的长度
+    :param min_smt_dist: 只用summit间距不大于此值的common peaks拟合模型，默认为ext/2
+    :param random_time: 随机化测试的次数
+    :param seed: 随机化测试的随机数种子
+    :param fit_sample, fit_bins: 见use_merged_peaks_fit_model
+    :param output_no_merge: 是否同时计算并标准化两组common peaks本身(不合并输出时需要)
+    :param processes: 读取bam文件、随机化测试以及按染色体并行的分类、合并和read计数使用的进程数
+    :param names: (pks1_name, pks2_name, rds1_name, rds2_name)，默认由文件名得到，没有文件名时为sample1, sample2
+    :param profiler: 记录各步骤资源消耗的StageProfiler
+    :param verbose: 是否打印每一步的信息
+    :param sweep_exts: 需要比较的多个延伸长度，所有长度的read数一次计算，每个长度分别拟合和标准化，
+                       统计结果保存在extension_sweep中；其它结果仍然使用ext
+    :param sweep_min_smt_dist: 比较延伸长度时使用的summit间距，默认为每个延伸长度的一半
+    :return: MAnormResult
+    """
+    profiler = profiler or StageProfiler()
+    if names is None:
+        names = [file_label(fp) if isinstance(fp, basestring) else 'sample%d' % (i % 2 + 1)
+                 for (i, fp) in enumerate([pks1, pks2, reads_pos1, reads_pos2])]
+    pks1_name, pks2_name, rds1_name, rds2_name = names
+    # 先读取两组peaks, 读取reads时才知道需要哪些范围
+    if isinstance(pks1, basestring):
+        pks1 = load_peaks(pks1, profiler, '1')
+    if isinstance(pks2, basestring):
+        pks2 = load_peaks(pks2, profiler, '2')
+    if isinstance(reads_pos1, basestring) or isinstance(reads_pos2, basestring):
+        regions = read_regions([pks1, pks2], reads_extension(ext, sweep_exts))
+        if isinstance(reads_pos1, basestring):
+            reads_pos1 = load_reads(reads_pos1, shift1, profiler, '1', processes, regions=regions)
+        if isinstance(reads_pos2, basestring):
+            reads_pos2 = load_reads(reads_pos2, shift2, profiler, '2', processes, regions=regions)
+    if min_smt_dist is None:
+        min_smt_dist = ext / 2
+
+    _say(verbose, 'Step1: Classify the 2 peaks by overlap')
+    with profiler.stage('classify', peaks1=get_peaks_size(pks1), peaks2=get_peaks_size(pks2),
+                        processes=processes) as counts:
+        pks1_uniq, pks1_com, pks2_uniq, pks2_com = get_common_peaks(pks1, pks2, processes)
+        counts['common1'], counts['common2'] = get_peaks_size(pks1_com), get_peaks_size(pks2_com)
+    _say(verbose, '%s: %d(unique) %d(common)\n%s: %d(unique) %d(common)' %
+         (pks1_name, get_peaks_size(pks1_uniq), get_peaks_size(pks1_com),
+          pks2_name, get_peaks_size(pks2_uniq), get_peaks_size(pks2_com)))
+
+    _say(verbose, 'Step2: Random overlap testing, test time is %d' % random_time)
+    with profiler.stage('permutation', permutations=random_time, processes=processes):
+        seed, random_counts = random_overlap_test(pks1, pks2, random_time, seed, processes)
+        overlap_stats = summarize_random_overlap(get_peaks_size(pks1_com), random_counts)
+    _say(verbose, 'fold change: mean={0:f}, std={1:f}'.format(overlap_stats['fold_change_mean'],
+                                                              overlap_stats['fold_change_std']))
+    _say(verbose, 'empirical p-value={0:g} (random seed={1:d})'.format(overlap_stats['empirical_pvalue'], seed))
+    _say(verbose, 'common peaks of %s in random: mean={0:.1f}, std={1:.1f}, min={2:.0f}, median={3:.1f}, '
+                  'max={4:.0f}'.format(overlap_stats['null_mean'], overlap_stats['null_std'],
+                                       overlap_stats['null_min'], overlap_stats['null_median'],
+                                       overlap_stats['null_max']) % pks1_name)
+
+    _say(verbose, 'Step3: Merging common peaks')
+    with profiler.stage('merge', processes=processes) as counts:
+        merged_pks, summit2summit_dist = merge_common_peaks(pks1_com, pks2_com, processes)
+        counts['merged_peaks'] = get_peaks_size(merged_pks)
+    _say(verbose, 'merged peaks: %d' % get_peaks_size(merged_pks))
+    if get_peaks_size(merged_pks) == 0:
+        raise ValueError('No common peaks!!')
+
+    _say(verbose, 'Step4: Calculating peaks read density')
+    # 只有不合并common peaks输出时才需要计算两组common peaks本身
+    all_pks = [pks1_uniq, pks2_uniq, merged_pks]
+    if output_no_merge:
+        all_pks += [pks1_com, pks2_com]
+    extension_sweep = None
+    if not sweep_exts:
+        with profiler.stage('density', peaks=sum(get_peaks_size(pks) for pks in all_pks), processes=processes):
+            cal_peak_tables_read_density(all_pks, reads_pos1, reads_pos2, ext, processes)
+    else:
+        exts = sorted(set(sweep_exts) | set([ext]))
+        with profiler.stage('density', peaks=sum(get_peaks_size(pks) for pks in all_pks), processes=processes,
+                            extensions=len(exts)):
+            counts1, counts2 = count_peak_tables_reads(all_pks, reads_pos1, reads_pos2, exts, processes)
+        _say(verbose, 'Comparing extensions: %s' % ', '.join(str(e) for e in exts))
+        extension_sweep = []
+        with profiler.stage('extension_sweep', extensions=len(exts)):
+            for (i, sweep_ext) in enumerate(exts):
+                set_peak_tables_read_density(all_pks, [c[i] for c in counts1], [c[i] for c in counts2], sweep_ext)
+                sweep_dist = sweep_min_smt_dist if sweep_min_smt_dist is not None else sweep_ext / 2
+                sweep_fit, sweep_info = use_merged_peaks_fit_model(merged_pks, summit2summit_dist, sweep_dist,
+                                                                   fit_sample, fit_bins, seed)
+                normalize_peak_tables([pks1_uniq, pks2_uniq, merged_pks], sweep_fit)
+                extension_sweep.append(_extension_stats(sweep_ext, sweep_dist, sweep_fit, sweep_info,
+                                                        pks1_uniq, pks2_uniq, merged_pks))
+                _say(verbose, 'extension %d: M = %f * A + %f, common peaks M sd=%f' %
+                     (sweep_ext, sweep_fit[1], sweep_fit[0], extension_sweep[-1]['common_M_sd']))
+        # 之后的步骤使用-e的结果
+        i = exts.index(ext)
+        set_peak_tables_read_density(all_pks, [c[i] for c in counts1], [c[i] for c in counts2], ext)
+
+    _say(verbose, 'Step5: Using merged common peaks to fitting all peaks')
+    with profiler.stage('fit') as counts:
+        ma_fit, fit_info = use_merged_peaks_fit_model(merged_pks, summit2summit_dist, min_smt_dist,
+                                                      fit_sample, fit_bins, seed)
+        counts.update(points=fit_info['n_points'], iterations=fit_info['iterations'])
+    _say(verbose, 'robust fit on %d points (%s, %d selected peaks): %d iterations, %s' %
+         (fit_info['n_points'], fit_info['mode'], fit_info['n_selected'], fit_info['iterations'],
+          'converged' if fit_info['converged'] else 'NOT converged'))
+    if ma_fit[0] >= 0:
+        _say(verbose, 'Model for normalization: M = %f * A + %f' % (ma_fit[1], ma_fit[0]))
+    else:
+        _say(verbose, 'Model for normalization: M = %f * A - %f' % (ma_fit[1], abs(ma_fit[0])))
+
+    _say(verbose, 'Step6: Normalizing all peaks')
+    with profiler.stage('normalize', peaks=sum(get_peaks_size(pks) for pks in all_pks)):
+        normalize_peak_tables(all_pks, ma_fit)
+
+    return MAnormResult(pks1_uniq, pks1_com, pks2_uniq, pks2_com, merged_pks, summit2summit_dist, ma_fit, fit_info,
+                        seed, random_counts, overlap_stats, pks1_name, pks2_name, rds1_name, rds2_name,
+                        extension_sweep)
+
+
+def write_results(result, output_dir, output_no_merge=False, overlap_dependent=False, biased_pvalue=0.01,
+                  biased_mvalue=1., unbiased_mvalue=1., compress=False, columnar=None, chrom_sizes=None,
+                  figures=True, figures_in_background=True, profiler=None):
+    """
+    将run_manorm的结果按MAnorm的目录结构输出到output_dir中(目录需已存在)，目录名同时作为这次比较的名字
+    :param result: MAnormResult
+    :param output_no_merge: 是否同时输出两个样本各自的peaks表(run_manorm也需要使用此选项)
+    :param figures_in_background: 是否在后台进程中画图(在进程池的工作进程中不能再创建子进程)
+    :param profiler: 记录各步骤资源消耗的StageProfiler
+    其它参数见bin/MAnorm的命令行选项
+    """
+    profiler = profiler or StageProfiler()
+    output_dir = os.path.abspath(output_dir)
+    comparison_name = os.path.basename(output_dir)
+    pks1_uniq, pks1_com, pks2_uniq, pks2_com = result.pks1_unique, result.pks1_common, result.pks2_unique, \
+        result.pks2_common
+    merged_pks, ma_fit = result.merged_pks, result.ma_fit
+    pks1_name, pks2_name, rds1_name, rds2_name = result.pks1_name, result.pks2_name, result.rds1_name, \
+        result.rds2_name
+
+    n_output = get_peaks_size(pks1_uniq) + get_peaks_size(merged_pks) + get_peaks_size(pks2_uniq)
+    figures_dir, filters_dir, tracks_dir = [os.path.join(output_dir, name) for name in
+                                            ('output_figures', 'output_filters', 'output_tracks')]
+    for folder in (figures_dir, filters_dir, tracks_dir):
+        os.mkdir(folder)
+    figs_proc = None
+    if figures and figures_in_background:
+        # 图在后台进程中画，同时输出各个表格
+        figs_proc = start_drawing_figs(pks1_uniq, pks2_uniq, merged_pks, pks1_name, pks2_name, ma_fit,
+                                       rds1_name, rds2_name, figures_dir)
+    elif figures:
+        with profiler.stage('output_figures', peaks=n_output):
+            draw_figs_to_show_data(pks1_uniq, pks2_uniq, merged_pks, pks1_name, pks2_name, ma_fit,
+                                   rds1_name, rds2_name, figures_dir)
+    if output_no_merge:
+        n_sample_peaks = sum(get_peaks_size(pks) for pks in (pks1_uniq, pks1_com, pks2_uniq, pks2_com))
+        with profiler.stage('output_sample_peaks', peaks=n_sample_peaks):
+            output_normalized_peaks(pks1_uniq, pks1_com, os.path.join(output_dir, pks1_name + '_MAvalues.xls'),
+                                    rds1_name, rds2_name, compress)
+            output_normalized_peaks(pks2_uniq, pks2_com, os.path.join(output_dir, pks2_name + '_MAvalues.xls'),
+                                    rds1_name, rds2_name, compress)
+    all_peaks_fp = os.path.join(output_dir, comparison_name + '_all_peak_MAvalues')
+    with profiler.stage('output_all_peaks', peaks=n_output):
+        output_3set_normalized_peaks(pks1_uniq, merged_pks, pks2_uniq, all_peaks_fp + '.xls',
+                                     pks1_name, pks2_name, rds1_name, rds2_name, compress)
+    if columnar is not None:
+        with profiler.stage('output_columnar', peaks=n_output, format=columnar):
+            output_columnar_peaks(pks1_uniq, merged_pks, pks2_uniq, all_peaks_fp,
+                                  pks1_name, pks2_name, rds1_name, rds2_name, columnar)
+    with profiler.stage('output_tracks', peaks=n_output):
+        output_peaks_tracks(pks1_uniq, pks2_uniq, merged_pks, comparison_name, chrom_sizes, compress, tracks_dir)
+    if result.extension_sweep:
+        output_extension_sweep(result.extension_sweep,
+                               os.path.join(output_dir, comparison_name + '_extension_sweep.xls'))
+    with profiler.stage('output_unbiased', peaks=n_output):
+        output_unbiased_peaks(pks1_uniq, pks2_uniq, merged_pks, unbiased_mvalue, overlap_dependent, compress,
+                              filters_dir)
+    with profiler.stage('output_biased', peaks=n_output):
+        output_biased_peaks(pks1_uniq, pks2_uniq, merged_pks, biased_mvalue, biased_pvalue, overlap_dependent,
+                            compress, filters_dir)
+    if figs_proc is not None:
+        # 只记录表格输出完以后还需要等待画图的时间
+        with profiler.stage('output_figures_wait', peaks=n_output):
+            figs_proc.join()
+        if figs_proc.exitcode != 0:
+            print '@warning: failed to draw the figures (exit code %s)' % figs_proc.exitcode
+
+
+# run_manorm和write_results各自使用的compare_samples参数
+_ANALYSIS_PARAMS = ('ext', 'min_smt_dist', 'random_time', 'seed', 'fit_sample', 'fit_bins', 'output_no_merge',
+                    'sweep_exts', 'sweep_min_smt_dist')
+
+
+def compare_samples(pks1, pks2, reads_pos1, reads_pos2, output_dir, pks1_name, pks2_name, rds1_name, rds2_name,
+                    processes=1, figures_in_background=True, profiler=None, **params):
+    """
+    完整的两样本比较：run_manorm之后用write_results将结果输出到output_dir中
+    :param params: run_manorm和write_results的参数(见comparison_params)
+    :return: 结果摘要, 见MAnormResult.summary, 另有comparison_name(输出文件名的前缀, 即output_dir的目录名)
+    """
+    profiler = profiler or StageProfiler()
+    analysis_params = dict((key, value) for (key, value) in params.items() if key in _ANALYSIS_PARAMS)
+    output_params = dict((key, value) for (key, value) in params.items()
+                         if key not in _ANALYSIS_PARAMS or key == 'output_no_merge')
+    result = run_manorm(pks1, pks2, reads_pos1, reads_pos2, processes=processes,
+                        names=(pks1_name, pks2_name, rds1_name, rds2_name), profiler=profiler, verbose=True,
+                        **analysis_params)
+    print 'Step7: Output result'
+    write_results(result, output_dir, figures_in_background=figures_in_background, profiler=profiler,
+                  **output_params)
+    summary = result.summary()
+    summary['comparison_name'] = os.path.basename(os.path.abspath(output_dir))
+    return summary
@@ -0,0 +1,154 @@
+# coding=utf-8
+# MAnorm的结果图。matplotlib在真正画图时才导入，点数很多时散点图降采样并栅格化，
+# 单组数据改画六边形密度图
+from math import log
+from multiprocessing import Process
+import os
+
+import numpy as np
+
+# 一张图中的点数超过此值时降采样散点或改画密度图
+SCATTER_MAX_POINTS = 50000
+# 六边形密度图x方向的格子数
+HEXBIN_GRID_SIZE = 200
+# -log10(p-value)颜色的上限
+MAX_LOG10_PVALUE = 50
+
+
+def _pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    return plt
+
+
+def _figure_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name):
+    """
+    画图用到的数组，每组peaks只取一次
+    :return: [(组名, 颜色, M值, A值, 标准化M值, 标准化A值, -log10(p-value))]
+    """
+    groups = []
+    for (name, color, pks) in ((' '.join([pks1_name, 'unique']), 'b', pks1_uni),
+                               (' '.join([pks2_name, 'unique']), 'g', pks2_uni),
+                               ('merged common peaks', 'r', merged_pks)):
+        groups.append((name, color, pks.mvalue, pks.avalue, pks.normed_mvalue, pks.normed_avalue,
+                       np.minimum(-pks.log_pvalue / log(10), MAX_LOG10_PVALUE)))
+    return groups
+
+
+def _sample_index(size, total, rng):
+    """
+    所有组合起来超过SCATTER_MAX_POINTS个点时，每组按相同比例随机抽取的下标，否则返回None
+    """
+    if total <= SCATTER_MAX_POINTS:
+        return None
+    n = int(round(size * float(SCATTER_MAX_POINTS) / total))
+    return np.sort(rng.choice(size, n, replace=False))
+
+
+def _scatter_groups(plt, groups, x_col, y_col, total, rng):
+    """
+    按组画散点图，点太多时每组降采样并栅格化，矢量元素不会随点数增长
+    """
+    for group in groups:
+        x, y = group[x_col], group[y_col]
+        idx = _sample_index(x.size, total, rng)
+        if idx is not None:
+            x, y = x[idx], y[idx]
+        plt.scatter(x, y, s=10, c=group[1], rasterized=idx is not None)
+
+
+def draw_figs_to_show_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name, ma_fit,
+                           reads1_name, reads2_name, output_dir='.'):
+    """
+    draw four figures to show data before and after rescaled
+    :param output_dir: 图片输出的目录
+    """
+    plt = _pyplot()
+    rng = np.random.RandomState(0)
+    groups = _figure_data(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name)
+    pks_names = [group[0] for group in groups]
+    total = sum(group[2].size for group in groups)
+
+    plt.figure(1).set_size_inches(16, 12)
+    _scatter_groups(plt, groups, 3, 2, total, rng)
+    plt.xlabel('A value')
+    plt.ylabel('M value')
+    plt.grid(axis='y')
+    plt.legend(pks_names, loc='best')
+    plt.title('before rescale')
+
+    # plot the fitting model into figure 1
+    avalues = np.concatenate([group[3] for group in groups])
+    if avalues.size > 0:
+        x = np.arange(min(avalues.min(), 10000), max(avalues.max(), 0), 0.01)
+        y = ma_fit[1] * x + ma_fit[0]
+        plt.plot(x, y, '-', color='k')
+    plt.savefig(os.path.join(output_dir, 'before_rescale.png'))
+    plt.close()
+
+    # plot the scatter plots of read count in merged common peaks between two chip-seq sets
+    plt.figure(2).set_size_inches(16, 12)
+    log2_density1, log2_density2 = np.ma.log2(merged_pks.read_density1), np.ma.log2(merged_pks.read_density2)
+    valid = ~(np.ma.getmaskarray(log2_density1) | np.ma.getmaskarray(log2_density2))
+    rd_x, rd_y = log2_density1.data[valid], log2_density2.data[valid]
+    if rd_x.size > SCATTER_MAX_POINTS:
+        plt.hexbin(rd_x, rd_y, gridsize=HEXBIN_GRID_SIZE, bins='log', mincnt=1, cmap='Reds')
+        plt.colorbar(label='log10(number of peaks)')
+    else:
+        plt.scatter(rd_x, rd_y, s=10, c='r', label=pks_names[2], alpha=0.5)
+        plt.legend(loc='upper left')
+    plt.xlabel(' log2 read density' + ' by ' + '"' + reads1_name + '" reads')
+    plt.ylabel(' log2 read density' + ' by ' + '"' + reads2_name + '" reads')
+    plt.grid(axis='y')
+    plt.title('Fitting Model via common peaks')
+    if rd_x.size > 0:
+        rx = np.arange(min(rd_x.min(), 1000), max(rd_x.max(), 0), 0.01)
+        ry = (2 - ma_fit[1]) * rx / (2 + ma_fit[1]) - 2 * ma_fit[0] / (2 + ma_fit[1])
+        plt.plot(rx, ry, '-', color='k')
+    plt.savefig(os.path.join(output_dir, 'log2_read_density.png'))
+    plt.close()
+
+    # plot the MA plot after rescale
+    plt.figure(3).set_size_inches(16, 12)
+    _scatter_groups(plt, groups, 5, 4, total, rng)
+    plt.xlabel('A value')
+    plt.ylabel('M value')
+    plt.grid(axis='y')
+    plt.legend(pks_names, loc='best')
+    plt.title('after rescale')
+    plt.savefig(os.path.join(output_dir, 'after_rescale.png'))
+    plt.close()
+
+    # generate MA plot for this set of peaks together with p-value
+    plt.figure(4).set_size_inches(16, 12)
+    normed_mvalues = np.concatenate([group[4] for group in groups])
+    normed_avalues = np.concatenate([group[5] for group in groups])
+    colors = np.concatenate([group[6] for group in groups])
+    if total > SCATTER_MAX_POINTS:
+        # 每个格子的颜色取其中最显著的peak
+        plt.hexbin(normed_avalues, normed_mvalues, C=colors, reduce_C_function=np.max,
+                   gridsize=HEXBIN_GRID_SIZE, cmap='jet')
+    else:
+        plt.scatter(normed_avalues, normed_mvalues, s=10, c=colors, cmap='jet')
+    plt.colorbar()
+    plt.grid(axis='y')
+    plt.xlabel('A value')
+    plt.ylabel('M value')
+    plt.title('-log10(P-value)')
+    plt.savefig(os.path.join(output_dir, '-log10_P-value.png'))
+    plt.close()
+
+
+def start_drawing_figs(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name, ma_fit,
+                       reads1_name, reads2_name, output_dir):
+    """
+    在后台进程中画图，主进程可以同时输出结果表格
+    :param output_dir: 图片输出的目录
+    :return: 画图的进程，用join()等待画完，exitcode不为0时画图出错
+    """
+    proc = Process(target=draw_figs_to_show_data,
+                   args=(pks1_uni, pks2_uni, merged_pks, pks1_name, pks2_name, ma_fit, reads1_name, reads2_name,
+                         os.path.abspath(output_dir)))
+    proc.start()
+    return proc
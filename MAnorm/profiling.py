@@ -0,0 +1,128 @@
+# coding=utf-8
+# 分步骤记录运行时间和内存：每一步的墙钟时间、CPU时间、进程的最大常驻内存以及处理的数据量，
+# 运行结束后写成JSON报告
+from contextlib import contextmanager
+import json
+import resource
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # python2没有tracemalloc, 只记录最大常驻内存
+    tracemalloc = None
+
+
+def _cpu_seconds():
+    """
+    本进程及已结束子进程(如随机化测试的进程池)的CPU时间之和
+    """
+    usage = 0.
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        usage += ru.ru_utime + ru.ru_stime
+    return usage
+
+
+def _max_rss_bytes(who=resource.RUSAGE_SELF):
+    """
+    最大常驻内存，linux上ru_maxrss的单位是KB, macOS上是字节
+    """
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class StageProfiler(object):
+    """
+    按步骤记录资源消耗:
+
+        profiler = StageProfiler()
+        with profiler.stage('classify') as counts:
+            ...
+            counts['peaks'] = n
+        profiler.write_json('profile.json')
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        :param trace_memory: 是否用tracemalloc记录python对象内存的峰值(仅python3, 会拖慢运行)
+        """
+        self.stages = []
+        self.trace_memory = trace_memory and tracemalloc is not None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._wall_start, self._cpu_start = time.time(), _cpu_seconds()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        记录一个步骤，with语句返回的字典用来填写这一步处理的数据量
+        :param name: 步骤名
+        :param counts: 步骤开始前就知道的数据量
+        """
+        counts = dict(counts)
+        wall_start, cpu_start = time.time(), _cpu_seconds()
+        rss_start = _max_rss_bytes()
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        try:
+            yield counts
+        finally:
+            record = {
+                'stage': name,
+                'wall_seconds': time.time() - wall_start,
+                'cpu_seconds': _cpu_seconds() - cpu_start,
+                'max_rss_bytes': _max_rss_bytes(),
+                'max_rss_growth_bytes': _max_rss_bytes() - rss_start,
+                'counts': counts,
+            }
+            if self.trace_memory:
+                record['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            self.stages.append(record)
+
+    def elapsed(self):
+        """
+        从创建到现在的墙钟时间(秒)
+        """
+        return time.time() - self._wall_start
+
+    def report(self, **info):
+        """
+        :param info: 需要一起记录的其它信息(如运行参数)
+        :return: 可以序列化成JSON的字典
+        """
+        report = dict(info)
+        report.update({
+            'wall_seconds': self.elapsed(),
+            'cpu_seconds': _cpu_seconds() - self._cpu_start,
+            'max_rss_bytes': _max_rss_bytes(),
+            'children_max_rss_bytes': _max_rss_bytes(resource.RUSAGE_CHILDREN),
+            'stages': self.stages,
+        })
+        return report
+
+    def write_json(self, fp, **info):
+        """
+        将报告写成JSON文件
+        :param fp: 输出文件路径
+        :param info: 需要一起记录的其它信息
+        """
+        with open(fp, 'w') as fo:
+            json.dump(self.report(**info), fo, indent=2, sort_keys=True, default=_json_default)
+
+
+def _json_default(value):
+    # numpy的标量类型
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def start_cprofile():
+    """
+    开始用cProfile记录运行情况，返回的对象用dump_stats(文件路径)写出，可以用pstats或snakeviz查看
+    """
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
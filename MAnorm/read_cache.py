@@ -0,0 +1,118 @@
+# coding=utf-8
+# read位点的磁盘缓存：解析后的位点按染色体排好序写成二进制文件，之后的运行直接内存映射，
+# 同一节点上的多个任务共享同一份page cache
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# 缓存格式变化时增加版本号，旧的缓存会自动失效
+CACHE_VERSION = 1
+# 默认的缓存目录由环境变量指定，不设置时不使用缓存
+CACHE_DIR_ENV = 'MANORM_CACHE_DIR'
+
+
+def default_cache_dir():
+    """
+    默认的缓存目录，来自环境变量MANORM_CACHE_DIR
+    """
+    return os.environ.get(CACHE_DIR_ENV) or None
+
+
+def read_cache_key(reads_fp, shift, **params):
+    """
+    根据read文件的路径、大小、修改时间、平移量以及其它读取参数生成缓存的键，
+    文件被修改或者参数改变后对应的缓存会自动失效
+    :param reads_fp: read文件路径
+    :param shift: <int>平移量
+    :param params: 其它会影响位点结果的读取参数(如bam的MAPQ过滤)
+    :return: 缓存键(sha1十六进制字符串)
+    """
+    stat = os.stat(reads_fp)
+    fields = [CACHE_VERSION, os.path.abspath(reads_fp), stat.st_size, repr(stat.st_mtime), shift,
+              sorted(params.items())]
+    return hashlib.sha1(json.dumps(fields)).hexdigest()
+
+
+def _cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key)
+
+
+def load_cached_reads(cache_dir, key):
+    """
+    以内存映射的方式读取缓存的read位点
+    :param cache_dir: 缓存目录
+    :param key: 缓存键
+    :return: {chrm: 升序的只读numpy数组(memmap)}, 缓存不存在时返回None
+    """
+    path = _cache_path(cache_dir, key)
+    try:
+        with open(os.path.join(path, 'index.json')) as fi:
+            index = json.load(fi)
+        positions = np.load(os.path.join(path, 'positions.npy'), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    return {str(chrm): positions[start:end] for (chrm, start, end) in index['chromosomes']}
+
+
+def save_cached_reads(cache_dir, key, reads_pos):
+    """
+    将read位点写入缓存。先写到临时目录再改名，并发的任务不会读到写了一半的缓存
+    :param cache_dir: 缓存目录
+    :param key: 缓存键
+    :param reads_pos: {chrm: 升序的numpy数组}
+    """
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    chrms = sorted(reads_pos.keys())
+    total = sum(reads_pos[chrm].size for chrm in chrms)
+    dtype = np.result_type(*[reads_pos[chrm].dtype for chrm in chrms]) if chrms else np.int32
+    tmp_path = tempfile.mkdtemp(prefix='.%s.' % key, dir=cache_dir)
+    try:
+        # mkdtemp创建的目录只有自己可读，缓存需要能被其它任务共享
+        os.chmod(tmp_path, 0o755)
+        positions = np.lib.format.open_memmap(os.path.join(tmp_path, 'positions.npy'), mode='w+',
+                                              dtype=dtype, shape=(total,))
+        index, offset = [], 0
+        for chrm in chrms:
+            size = reads_pos[chrm].size
+            positions[offset:offset + size] = reads_pos[chrm]
+            index.append((chrm, offset, offset + size))
+            offset += size
+        positions.flush()
+        del positions
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as fo:
+            json.dump({'version': CACHE_VERSION, 'chromosomes': index}, fo)
+        try:
+            os.rename(tmp_path, _cache_path(cache_dir, key))
+        except OSError:
+            # 另一个任务已经写好了同样的缓存
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def remove_cached_reads(cache_dir, key):
+    """
+    删除一个缓存项
+    """
+    shutil.rmtree(_cache_path(cache_dir, key), ignore_errors=True)
+
+
+def clear_read_cache(cache_dir):
+    """
+    清空缓存目录中所有的缓存项，目录中不是缓存项的文件不会被删除
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if os.path.isfile(os.path.join(cache_dir, name, 'index.json')):
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
@@ -0,0 +1,62 @@
+# coding=utf-8
+# 按染色体并行：各条染色体互相独立的计算(peaks分类、合并、read密度)按染色体分给进程池，
+# 染色体按工作量从大到小分配到当前负载最小的进程，结果按染色体名返回，由调用者按固定顺序合并
+from multiprocessing import Pool
+
+# 总工作量(peak数、窗口数)小于此值时进程池的开销比计算本身大，直接在本进程中计算
+MIN_PARALLEL_WORK = 200000
+
+# 分给工作进程的共享数据(peaks表、read位点数组)，在创建进程池之前设置，
+# 工作进程fork后直接使用父进程的内存，不需要pickle复制
+_shared = {}
+
+
+def balance_chromosomes(chrms, weights, n_bins):
+    """
+    按工作量把染色体分成n_bins组：从大到小依次放入当前总量最小的组(LPT调度)
+    :param chrms: 染色体名列表
+    :param weights: 每条染色体的工作量
+    :param n_bins: 组数
+    :return: 染色体名列表的列表，去掉空组
+    """
+    bins = [[] for _ in xrange(max(1, n_bins))]
+    loads = [0] * len(bins)
+    # 工作量相同时按原来的顺序，保证分组结果是确定的
+    order = sorted(xrange(len(chrms)), key=lambda i: (-weights[i], i))
+    for i in order:
+        k = loads.index(min(loads))
+        bins[k].append(chrms[i])
+        loads[k] += weights[i]
+    return [chrms_bin for chrms_bin in bins if chrms_bin]
+
+
+def _run_chromosomes(args):
+    func, chrms = args
+    return [(chrm, func(chrm, **_shared)) for chrm in chrms]
+
+
+def map_chromosomes(func, chrms, weights, processes=1, **shared):
+    """
+    对每条染色体计算func(chrm, **shared)
+    :param func: 模块级函数(工作进程中按名字找到)，只依赖chrm和shared
+    :param chrms: 染色体名列表
+    :param weights: 每条染色体的工作量，用于分组和判断是否值得并行
+    :param processes: 进程数
+    :param shared: 所有染色体共用的数据，工作进程通过fork共享
+    :return: {chrm: func的返回值}
+    """
+    chrms = list(chrms)
+    if processes <= 1 or len(chrms) <= 1 or sum(weights) < MIN_PARALLEL_WORK:
+        return dict((chrm, func(chrm, **shared)) for chrm in chrms)
+    bins = balance_chromosomes(chrms, weights, min(processes, len(chrms)))
+    _shared.update(shared)
+    try:
+        pool = Pool(len(bins))
+        try:
+            results = pool.map(_run_chromosomes, [(func, chrms_bin) for chrms_bin in bins], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _shared.clear()
+    return dict(item for chunk in results for item in chunk)
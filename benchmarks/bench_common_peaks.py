@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+get_common_peaks的性能对比：原来逐个peak扫描另一组全部peaks的O(n*m)实现与排序扫描实现。
+两种实现的分类结果必须完全一致。
+
+    python benchmarks/bench_common_peaks.py -n 200000
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+
+import numpy as np
+
+# 不需要安装MAnorm, 直接使用仓库中的代码
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MAnorm.peaks import PeakTable, get_common_peaks
+
+
+def naive_get_common_peaks(pks1, pks2):
+    """
+    原来的实现：pks1中的每个peak都和同一条染色体上pks2的所有peaks计算一次重叠
+    """
+    flag1, flag2 = np.zeros(len(pks1), dtype=bool), np.zeros(len(pks2), dtype=bool)
+    for chrm in set(pks1.keys()).intersection(pks2.keys()):
+        lo1, hi1 = pks1.chrm_range(chrm)
+        lo2, hi2 = pks2.chrm_range(chrm)
+        starts2, ends2 = pks2.start[lo2:hi2], pks2.end[lo2:hi2]
+        for i in xrange(lo1, hi1):
+            claus = 1.0 * (pks1.end[i] - starts2) * (ends2 - pks1.start[i])
+            overlap_locs = np.where(claus > 0)[0]
+            if overlap_locs.size > 0:
+                flag1[i] = True
+                flag2[lo2 + overlap_locs] = True
+    return pks1.subset(~flag1), pks1.subset(flag1), pks2.subset(~flag2), pks2.subset(flag2)
+
+
+def random_peaks(rng, n, chrm_sizes, min_len=200, max_len=3000):
+    """
+    在给定的染色体上均匀随机生成n个peaks
+    """
+    names = sorted(chrm_sizes.keys())
+    sizes = np.array([chrm_sizes[c] for c in names], dtype=np.float64)
+    chrm = rng.choice(len(names), size=n, p=sizes / sizes.sum())
+    lengths = rng.randint(min_len, max_len, size=n)
+    starts = (rng.random_sample(n) * (sizes[chrm] - lengths)).astype(np.int64)
+    return PeakTable.from_columns(np.array(names)[chrm], starts, starts + lengths)
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    opt_parser = OptionParser()
+    opt_parser.add_option('-n', dest='peaks', type='int', default=20000,
+                          help='number of peaks in each peak set, default=20000.')
+    opt_parser.add_option('--seed', dest='seed', type='int', default=0, help='random seed, default=0.')
+    opt_parser.add_option('--skip-naive', dest='skip_naive', action='store_true', default=False,
+                          help='only time the sort-sweep implementation.')
+    values, _ = opt_parser.parse_args()
+
+    rng = np.random.RandomState(values.seed)
+    chrm_sizes = {'chr%d' % (i + 1): int(250e6 * 0.9 ** i) for i in range(22)}
+    pks1 = random_peaks(rng, values.peaks, chrm_sizes)
+    pks2 = random_peaks(rng, values.peaks, chrm_sizes)
+
+    fast_time, fast = timeit(get_common_peaks, pks1, pks2)
+    print 'sort-sweep: %.3f s, %d/%d common peaks' % (fast_time, len(fast[1]), len(fast[3]))
+    if values.skip_naive:
+        return
+    naive_time, naive = timeit(naive_get_common_peaks, pks1, pks2)
+    print 'naive scan: %.3f s, %d/%d common peaks' % (naive_time, len(naive[1]), len(naive[3]))
+    for fast_pks, naive_pks in zip(fast, naive):
+        assert np.array_equal(fast_pks.start, naive_pks.start) and np.array_equal(fast_pks.end, naive_pks.end)
+    print 'results identical, speedup %.1fx' % (naive_time / max(fast_time, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
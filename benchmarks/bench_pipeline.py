@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+MAnorm各个步骤的性能测试：在synthetic_data.py生成的模拟数据上分别计时读取、分类、随机化、合并、
+read密度、拟合、标准化和各个输出函数，结果写成JSON文件。指定--baseline时与之前的结果逐步骤比较，
+用来发现不同版本之间的性能退化。
+
+    python benchmarks/bench_pipeline.py --peaks 100000 --reads 20000000 -o bench_HEAD.json
+    python benchmarks/bench_pipeline.py --data bench_data --baseline bench_HEAD.json -o bench_new.json
+"""
+from optparse import OptionParser
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# 不需要安装MAnorm, 直接使用仓库中的代码
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MAnorm.MAnorm_io import read_peaks, read_reads, read_regions, output_3set_normalized_peaks, \
+    output_columnar_peaks, output_peaks_tracks, output_unbiased_peaks, output_biased_peaks, read_chrom_sizes
+from MAnorm.peaks import get_common_peaks, randomize_peaks, random_overlap_test, merge_common_peaks, \
+    cal_peak_tables_read_density, use_merged_peaks_fit_model, normalize_peak_tables
+from MAnorm.pipeline import reads_extension, run_manorm
+from MAnorm.profiling import _max_rss_bytes
+
+from synthetic_data import add_data_options, data_params, generate_dataset
+
+# 与baseline相比慢了这么多倍以上的步骤会被标出
+REGRESSION_RATIO = 1.2
+
+
+def _revision():
+    """
+    当前代码的git版本，不是git仓库时返回None
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+                                               stderr=devnull).strip()
+            dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                            cwd=repo_dir, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+def _data_files(data_dir):
+    """
+    synthetic_data.py在data_dir中生成的文件
+    """
+    files = {'chrom_sizes': os.path.join(data_dir, 'genome.chrom.sizes')}
+    for sample in (1, 2):
+        files['peaks%d' % sample] = os.path.join(data_dir, 'sample%d_peaks.bed' % sample)
+        files['reads%d' % sample] = os.path.join(data_dir, 'sample%d_reads.bed' % sample)
+        bam = os.path.join(data_dir, 'sample%d_reads.bam' % sample)
+        if os.path.exists(bam):
+            files['bam%d' % sample] = bam
+    return files
+
+
+class StepTimer(object):
+    """
+    每个步骤运行repeat次，记录每次的墙钟时间
+    """
+
+    def __init__(self, repeat=3, steps=None):
+        self.repeat, self.steps, self.records = repeat, steps, []
+
+    def run(self, name, func, *args, **counts):
+        """
+        计时func(*args)，返回最后一次运行的结果
+        :param counts: 这一步处理的数据量
+        """
+        if self.steps is not None and name not in self.steps:
+            return func(*args)
+        seconds = []
+        for _ in xrange(self.repeat):
+            start = time.time()
+            result = func(*args)
+            seconds.append(time.time() - start)
+        self.records.append({'step': name, 'seconds': seconds, 'min': min(seconds),
+                             'median': float(np.median(seconds)), 'counts': counts})
+        print '%-32s %10.3f s (min of %d)' % (name, min(seconds), self.repeat)
+        return result
+
+
+def run_benchmarks(files, timer, ext=1000, random_time=5, processes=1):
+    """
+    按MAnorm的流程依次计时每个步骤
+    """
+    pks1 = timer.run('read_peaks', read_peaks, files['peaks1'])
+    pks2 = read_peaks(files['peaks2'])
+    reads_pos1 = timer.run('read_reads_bed', read_reads, files['reads1'], 100, processes)
+    reads_pos2 = read_reads(files['reads2'], 100, processes)
+    n_reads = sum(pos.size for pos in reads_pos1.values())
+    if 'bam1' in files:
+        timer.run('read_reads_bam', read_reads, files['bam1'], 100, processes, reads=n_reads)
+        regions = read_regions([pks1, pks2], ext)
+        timer.run('read_reads_bam_regions', read_reads, files['bam1'], 100, processes, 0, False, None, False,
+                  regions, 'regions', reads=n_reads)
+
+    n_peaks = len(pks1) + len(pks2)
+    pks1_uniq, pks1_com, pks2_uniq, pks2_com = timer.run('get_common_peaks', get_common_peaks, pks1, pks2,
+                                                         processes, peaks=n_peaks)
+    timer.run('randomize_peaks', randomize_peaks, pks2, np.random.RandomState(0), peaks=len(pks2))
+    timer.run('random_overlap_test', random_overlap_test, pks1, pks2, random_time, 0, processes,
+              peaks=n_peaks, permutations=random_time)
+    merged_pks, summit_dist = timer.run('merge_common_peaks', merge_common_peaks, pks1_com, pks2_com, processes,
+                                        peaks=len(pks1_com) + len(pks2_com))
+    all_pks = [pks1_uniq, pks2_uniq, merged_pks]
+    n_output = sum(len(pks) for pks in all_pks)
+    timer.run('cal_peaks_read_density', cal_peak_tables_read_density, all_pks, reads_pos1, reads_pos2, ext,
+              processes, peaks=n_output, reads=n_reads)
+    ma_fit, fit_info = timer.run('use_merged_peaks_fit_model', use_merged_peaks_fit_model, merged_pks,
+                                 summit_dist, ext / 2, peaks=len(merged_pks))
+    timer.run('normalize_peaks', normalize_peak_tables, all_pks, ma_fit, peaks=n_output)
+
+    output_dir = tempfile.mkdtemp(prefix='manorm_bench_')
+    try:
+        all_peaks_fp = os.path.join(output_dir, 'bench_all_peak_MAvalues')
+        timer.run('output_3set_normalized_peaks', output_3set_normalized_peaks, pks1_uniq, merged_pks, pks2_uniq,
+                  all_peaks_fp + '.xls', 'sample1', 'sample2', 'reads1', 'reads2', peaks=n_output)
+        timer.run('output_columnar_peaks', output_columnar_peaks, pks1_uniq, merged_pks, pks2_uniq, all_peaks_fp,
+                  'sample1', 'sample2', 'reads1', 'reads2', 'npz', peaks=n_output)
+        timer.run('output_peaks_tracks', output_peaks_tracks, pks1_uniq, pks2_uniq, merged_pks, 'bench',
+                  None, False, output_dir, peaks=n_output)
+        timer.run('output_unbiased_peaks', output_unbiased_peaks, pks1_uniq, pks2_uniq, merged_pks, 1., False,
+                  False, output_dir, peaks=n_output)
+        timer.run('output_biased_peaks', output_biased_peaks, pks1_uniq, pks2_uniq, merged_pks, 1., 0.01, False,
+                  False, output_dir, peaks=n_output)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {'peaks1': len(pks1), 'peaks2': len(pks2), 'reads1': n_reads, 'merged_common_peaks': len(merged_pks),
+            'fit_points': fit_info['n_points'], 'chromosomes': len(read_chrom_sizes(files['chrom_sizes']))}
+
+
+def check_extension_sweep(files, ext=1000):
+    """
+    比较多个延伸长度时，BAM按范围读取的reads与BED文件的reads得到的结果必须相同，
+    即读取的范围覆盖了最大的延伸长度
+    """
+    sweep_exts = [ext / 2, ext, ext * 4]
+    sweeps = []
+    for sample1, sample2 in (('reads1', 'reads2'), ('bam1', 'bam2')):
+        pks1, pks2 = read_peaks(files['peaks1']), read_peaks(files['peaks2'])
+        regions = read_regions([pks1, pks2], reads_extension(ext, sweep_exts))
+        # BED文件不去除重复的reads, BAM文件也保留重复的reads
+        reads_pos1, reads_pos2 = [read_reads(files[sample], 100, 1, 0, True, None, False, regions, 'regions')
+                                  for sample in (sample1, sample2)]
+        result = run_manorm(pks1, pks2, reads_pos1, reads_pos2, ext=ext, random_time=1, seed=0,
+                            sweep_exts=sweep_exts)
+        sweeps.append(result.extension_sweep)
+    if sweeps[0] != sweeps[1]:
+        raise AssertionError('extension sweep differs between BAM region fetch and BED input: %r != %r' %
+                             tuple(sweeps))
+    print 'extension sweep %s: BAM region fetch matches BED input' % ','.join(str(e) for e in sweep_exts)
+
+
+def compare_with_baseline(records, baseline_fp):
+    """
+    逐步骤打印与baseline的耗时比值(按最短时间)
+    """
+    with open(baseline_fp) as fi:
+        baseline = dict((record['step'], record) for record in json.load(fi)['steps'])
+    print '\n%-32s %10s %10s %8s' % ('step', 'baseline', 'current', 'ratio')
+    for record in records:
+        old = baseline.get(record['step'])
+        if old is None:
+            print '%-32s %10s %10.3f' % (record['step'], '-', record['min'])
+            continue
+        ratio = record['min'] / max(old['min'], 1e-9)
+        print '%-32s %10.3f %10.3f %7.2fx%s' % (record['step'], old['min'], record['min'], ratio,
+                                               ' *' if ratio > REGRESSION_RATIO else '')
+
+
+def main():
+    opt_parser = OptionParser(usage='%prog [--data folder | data options] [-o results.json] [options]')
+    opt_parser.add_option('--data', dest='data',
+                          help='folder of data generated by synthetic_data.py. If not given, the data is '
+                               'generated into a temporary folder with the data options below.')
+    opt_parser.add_option('--keep-data', dest='keep_data',
+                          help='generate the data into this folder and keep it for later runs.')
+    opt_parser.add_option('-o', dest='output', help='JSON file to write the results into.')
+    opt_parser.add_option('--baseline', dest='baseline',
+                          help='JSON results of an earlier run to compare with, steps more than %.1fx slower '
+                               'are marked with *.' % REGRESSION_RATIO)
+    opt_parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                          help='number of runs of every step, the minimum is compared, default=3.')
+    opt_parser.add_option('--steps', dest='steps',
+                          help='comma separated names of the steps to time, default all.')
+    opt_parser.add_option('-e', dest='extension', type='int', default=1000, help='extension size, default=1000.')
+    opt_parser.add_option('-n', dest='random_time', type='int', default=5,
+                          help='number of random permutations, default=5.')
+    opt_parser.add_option('--threads', dest='threads', type='int', default=1,
+                          help='number of processes, default=1.')
+    add_data_options(opt_parser)
+    values, _ = opt_parser.parse_args()
+
+    data_dir, temp_dir = values.data, None
+    if data_dir is None:
+        data_dir = values.keep_data or tempfile.mkdtemp(prefix='manorm_bench_data_')
+        temp_dir = None if values.keep_data else data_dir
+        print 'generating data into %s ...' % data_dir
+        generate_dataset(data_dir, **data_params(values))
+    try:
+        timer = StepTimer(values.repeat, values.steps.split(',') if values.steps else None)
+        files = _data_files(data_dir)
+        sizes = run_benchmarks(files, timer, values.extension, values.random_time, values.threads)
+        if 'bam1' in files:
+            check_extension_sweep(files, values.extension)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    results = {
+        'revision': _revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+                        'processor': platform.processor()},
+        'data': {'folder': values.data, 'generated': data_params(values) if values.data is None else None,
+                 'sizes': sizes},
+        'options': {'extension': values.extension, 'random_time': values.random_time, 'threads': values.threads,
+                    'repeat': values.repeat},
+        'max_rss_bytes': _max_rss_bytes(),
+        'steps': timer.records,
+    }
+    if values.output:
+        with open(values.output, 'w') as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+    if values.baseline:
+        compare_with_baseline(timer.records, values.baseline)
+
+
+if __name__ == '__main__':
+    main()
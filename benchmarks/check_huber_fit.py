@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+检查huber_fit与原来使用的statsmodels RLM(y, add_constant(x)).fit()给出相同的直线：在synthetic_data.py生成的
+模拟数据上按MAnorm的流程得到合并后的common peaks，用它们的M/A值分别拟合，另外再比较一些带离群点的随机数据。
+调整常数、尺度估计或收敛条件的改动会改变所有的M值，这里的系数或迭代次数不一致时以非0状态退出。
+需要安装statsmodels(MAnorm本身不再依赖它)。
+
+    python benchmarks/check_huber_fit.py --peaks 10000 --reads 1000000 --seeds 0,1,2
+"""
+from optparse import OptionParser
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+# 不需要安装MAnorm, 直接使用仓库中的代码
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MAnorm.MAnorm_io import read_peaks, read_reads
+from MAnorm.peaks import get_common_peaks, merge_common_peaks, cal_peak_tables_read_density, \
+    use_merged_peaks_fit_model, huber_fit
+
+from synthetic_data import add_data_options, data_params, generate_dataset
+
+# 两种实现的系数允许的最大差别
+TOLERANCE = 1e-10
+
+
+def rlm_fit(x, y):
+    """
+    原来的拟合方式
+    :return: ([截距, 斜率], 迭代次数)
+    """
+    from statsmodels import api as sm
+    result = sm.RLM(y, sm.add_constant(x)).fit()
+    return np.asarray(result.params), result.fit_history['iteration']
+
+
+def merged_peaks_cases(files, exts):
+    """
+    一组模拟数据在各个延伸长度下用于拟合的点，选择方式与use_merged_peaks_fit_model相同
+    :return: 生成器, 每次返回(延伸长度, 合并后的peaks表, summit间距, 拟合点的A值, 拟合点的M值)
+    """
+    pks1, pks2 = read_peaks(files['peaks1']), read_peaks(files['peaks2'])
+    reads_pos1, reads_pos2 = read_reads(files['reads1'], 100), read_reads(files['reads2'], 100)
+    pks1_com, pks2_com = get_common_peaks(pks1, pks2)[1::2]
+    merged_pks, summit_dist = merge_common_peaks(pks1_com, pks2_com)
+    for ext in exts:
+        cal_peak_tables_read_density([merged_pks], reads_pos1, reads_pos2, ext)
+        selected = summit_dist <= ext / 2
+        x, y = merged_pks.avalue[selected], merged_pks.mvalue[selected]
+        keep = (y >= -10) & (y <= 10)
+        yield ext, merged_pks, summit_dist, x[keep], y[keep]
+
+
+def random_cases(n_cases, seed=0):
+    """
+    随机的直线加上重尾噪声和一部分离群点
+    :return: 生成器, 每次返回(x, y)
+    """
+    rng = np.random.RandomState(seed)
+    for _ in xrange(n_cases):
+        n = rng.randint(20, 5000)
+        x = rng.uniform(0, 15, n)
+        y = rng.uniform(-1, 1) + rng.uniform(-0.2, 0.2) * x + rng.standard_t(3, n) * rng.uniform(0.1, 1)
+        outliers = rng.random_sample(n) < rng.uniform(0, 0.2)
+        y[outliers] += rng.normal(0, 5, outliers.sum())
+        yield x, y
+
+
+def compare(label, params, iterations, x, y):
+    """
+    :return: 两种实现是否一致
+    """
+    rlm_params, rlm_iterations = rlm_fit(x, y)
+    diff = np.abs(np.asarray(params) - rlm_params).max()
+    same = diff <= TOLERANCE and iterations == rlm_iterations
+    if not same:
+        print '%s: huber_fit %r (%d iterations) != RLM %r (%d iterations)' % \
+              (label, list(params), iterations, list(rlm_params), rlm_iterations)
+    return same, diff
+
+
+def main():
+    opt_parser = OptionParser(usage='%prog [data options] [--seeds 0,1,2] [--exts 500,1000,2000]')
+    opt_parser.add_option('--seeds', dest='seeds', default='0,1,2',
+                          help='comma separated seeds of the simulated data sets, default=0,1,2.')
+    opt_parser.add_option('--exts', dest='exts', default='500,1000,2000',
+                          help='comma separated extension sizes, default=500,1000,2000.')
+    opt_parser.add_option('--random', dest='random', type='int', default=200,
+                          help='number of random data sets with outliers, default=200.')
+    add_data_options(opt_parser)
+    values, _ = opt_parser.parse_args()
+    try:
+        import statsmodels
+    except ImportError:
+        print 'statsmodels is needed to compare huber_fit with RLM'
+        exit(2)
+
+    exts = [int(e) for e in values.exts.split(',')]
+    failed, max_diff, n_cases = 0, 0., 0
+    for seed in [int(s) for s in values.seeds.split(',')]:
+        data_dir = tempfile.mkdtemp(prefix='manorm_huber_')
+        try:
+            params = data_params(values)
+            params['seed'] = seed
+            files = generate_dataset(data_dir, **params)
+            for ext, merged_pks, summit_dist, x, y in merged_peaks_cases(files, exts):
+                ma_fit, fit_info = use_merged_peaks_fit_model(merged_pks, summit_dist, ext / 2)
+                same, diff = compare('data seed %d, ext %d' % (seed, ext), ma_fit, fit_info['iterations'], x, y)
+                print 'data seed %d, ext %d: %d points, M = %f * A + %f, max difference %.2e' % \
+                      (seed, ext, x.size, ma_fit[1], ma_fit[0], diff)
+                failed, max_diff, n_cases = failed + (not same), max(max_diff, diff), n_cases + 1
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    for i, (x, y) in enumerate(random_cases(values.random)):
+        params, info = huber_fit(x, y)
+        same, diff = compare('random case %d' % i, params, info['iterations'], x, y)
+        failed, max_diff, n_cases = failed + (not same), max(max_diff, diff), n_cases + 1
+
+    print '%d/%d fits match RLM, max coefficient difference %.2e' % (n_cases - failed, n_cases, max_diff)
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+生成确定性的模拟数据：两个样本的peaks(bed, 第四列为相对start的summit)和reads(按坐标排序的bed, 可选bam)。
+两组peaks中有一定比例的位点相同(位置带有随机偏移)，其中一部分位点在两个样本间的信号有差异；
+reads由peaks内的信号reads和全基因组均匀分布的背景reads组成。
+相同的参数和种子总是生成完全相同的文件(与分块方式无关)。
+
+    python benchmarks/synthetic_data.py -o bench_data --peaks 50000 --reads 10000000 --bam
+"""
+from optparse import OptionParser
+import os
+
+import numpy as np
+
+# hg19常染色体和X染色体的相对长度(Mb)，染色体数少于24时取前面的
+HUMAN_CHROM_MB = (249, 243, 198, 191, 181, 171, 159, 146, 141, 136, 135, 134, 115, 107, 103, 90, 81, 78, 59, 63,
+                  48, 51, 155, 59)
+READ_LENGTH = 36
+# 测序片段长度, reads相对片段中心平移FRAGMENT_LENGTH / 2
+FRAGMENT_LENGTH = 200
+# 每次写入文件的最大read数
+WRITE_CHUNK = 2000000
+
+
+def chrom_sizes(genome_size=3.1e9, n_chroms=24):
+    """
+    :return: [(chrm, size)], 染色体长度按人类基因组的比例分配
+    """
+    weights = np.array(HUMAN_CHROM_MB[:n_chroms], dtype=np.float64)
+    sizes = (weights / weights.sum() * genome_size).astype(np.int64)
+    names = ['chr%d' % (i + 1) for i in range(min(n_chroms, 22))] + ['chrX', 'chrY'][:max(0, n_chroms - 22)]
+    return zip(names, sizes.tolist())
+
+
+def _random_loci(rng, n, sizes):
+    """
+    按染色体长度在基因组上均匀地取n个位置
+    :return: (染色体编号数组, 位置数组)
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    chrm = rng.choice(sizes.size, size=n, p=sizes / sizes.sum())
+    return chrm, (rng.random_sample(n) * (sizes[chrm] - 10000)).astype(np.int64) + 5000
+
+
+def generate_peaks(n_peaks, sizes, overlap=0.6, diff_fraction=0.2, fold=4., seed=0):
+    """
+    生成两个样本的peaks和每个peak在本样本中的信号强度
+    :param n_peaks: 每个样本的peak数
+    :param sizes: 染色体长度列表
+    :param overlap: 两个样本共有位点的比例
+    :param diff_fraction: 共有位点中信号有差异的比例(一半在样本1中高, 一半在样本2中高)
+    :param fold: 差异位点的信号倍数
+    :param seed: 随机种子
+    :return: 两个样本的(染色体编号, start, end, summit, 信号强度)
+    """
+    rng = np.random.RandomState([seed, 0])
+    n_common = int(n_peaks * overlap)
+    common_chrm, common_center = _random_loci(rng, n_common, sizes)
+    common_strength = rng.lognormal(0., 1., n_common)
+    factor1, factor2 = np.ones(n_common), np.ones(n_common)
+    diff = rng.random_sample(n_common) < diff_fraction
+    up = rng.random_sample(n_common) < 0.5
+    factor1[diff & up], factor2[diff & ~up] = fold, fold
+    samples = []
+    for (sample, factor) in ((1, factor1), (2, factor2)):
+        sample_rng = np.random.RandomState([seed, sample])
+        uniq_chrm, uniq_center = _random_loci(sample_rng, n_peaks - n_common, sizes)
+        chrm = np.concatenate((common_chrm, uniq_chrm))
+        widths = np.clip(sample_rng.lognormal(6.7, 0.5, n_peaks), 150, 5000).astype(np.int64)
+        # 共有位点在两个样本中的位置略有不同
+        center = np.concatenate((common_center + (sample_rng.normal(0, 1, n_common) * widths[:n_common] / 4)
+                                 .astype(np.int64), uniq_center))
+        starts = center - widths // 2
+        summits = starts + (widths * sample_rng.uniform(0.3, 0.7, n_peaks)).astype(np.int64)
+        strength = np.concatenate((common_strength * factor, sample_rng.lognormal(0., 1., n_peaks - n_common)))
+        order = np.lexsort((starts, chrm))
+        samples.append(tuple(column[order] for column in (chrm, starts, starts + widths, summits, strength)))
+    return samples
+
+
+def write_peaks(fp, peaks, names):
+    """
+    写出bed格式的peaks，第四列是相对start的summit
+    """
+    chrm, starts, ends, summits = peaks[:4]
+    with open(fp, 'w') as fo:
+        for (c, s, e, m) in zip(chrm.tolist(), starts.tolist(), ends.tolist(), summits.tolist()):
+            fo.write('%s\t%d\t%d\t%d\n' % (names[c], s, e, m - s))
+
+
+def _chrom_reads(rng, size, n_background, summits, widths, n_signal):
+    """
+    生成一条染色体上的reads
+    :return: (按start排序的read起始位置, 是否为负链)
+    """
+    centers = np.repeat(summits, n_signal) + (rng.normal(0, 1, n_signal.sum()) * np.repeat(widths, n_signal) / 6) \
+        .astype(np.int64)
+    centers = np.concatenate((centers, rng.randint(0, size, n_background)))
+    reverse = rng.random_sample(centers.size) < 0.5
+    starts = np.where(reverse, centers + FRAGMENT_LENGTH // 2 - READ_LENGTH, centers - FRAGMENT_LENGTH // 2)
+    starts = np.clip(starts, 0, size - READ_LENGTH)
+    order = np.argsort(starts, kind='mergesort')
+    return starts[order], reverse[order]
+
+
+def iter_reads(all_peaks, sample, n_reads, sizes, frip=0.3, seed=0):
+    """
+    逐条染色体生成一个样本的reads
+    :param all_peaks: generate_peaks的结果
+    :param sample: 样本编号1或2
+    :param n_reads: read总数
+    :param frip: peaks中信号reads的比例
+    :return: 生成器, 每条染色体返回(染色体编号, 排好序的read起始位置, 是否为负链)
+    """
+    rng = np.random.RandomState([seed, 10 + sample])
+    # 共有位点在两组peaks中各出现一次，只用本样本的peaks放置信号
+    chrm, starts, ends, summits, signal = all_peaks[sample - 1]
+    n_signal = rng.multinomial(int(n_reads * frip), signal / signal.sum()) if signal.sum() > 0 \
+        else np.zeros(signal.size, dtype=np.int64)
+    n_background = rng.multinomial(n_reads - n_signal.sum(), np.asarray(sizes, dtype=np.float64) / sum(sizes))
+    for (i, size) in enumerate(sizes):
+        chrm_rng = np.random.RandomState([seed, 10 + sample, i])
+        on_chrm = chrm == i
+        yield (i,) + _chrom_reads(chrm_rng, size, n_background[i], summits[on_chrm],
+                                  (ends - starts)[on_chrm], n_signal[on_chrm])
+
+
+def write_reads_bed(fp, reads_iter, names):
+    """
+    写出bed格式的reads(chr, start, end, name, score, strand)
+    """
+    with open(fp, 'w') as fo:
+        for (i, starts, reverse) in reads_iter:
+            for lo in xrange(0, starts.size, WRITE_CHUNK):
+                chunk_starts, chunk_reverse = starts[lo:lo + WRITE_CHUNK], reverse[lo:lo + WRITE_CHUNK]
+                prefix, suffix = '%s\t' % names[i], '\tr\t0\t'
+                fo.writelines('%s%d\t%d%s%s\n' % (prefix, s, s + READ_LENGTH, suffix, '-' if r else '+')
+                              for (s, r) in zip(chunk_starts.tolist(), chunk_reverse.tolist()))
+
+
+def write_reads_bam(fp, reads_iter, names, sizes):
+    """
+    写出按坐标排序并建立索引的bam文件，需要pysam
+    """
+    import pysam
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': size} for (name, size) in zip(names, sizes)]}
+    with pysam.AlignmentFile(fp, 'wb', header=header) as fo:
+        for (i, starts, reverse) in reads_iter:
+            for (j, (s, r)) in enumerate(zip(starts.tolist(), reverse.tolist())):
+                read = pysam.AlignedSegment()
+                read.query_name = 'r%d_%d' % (i, j)
+                read.flag = 16 if r else 0
+                read.reference_id = i
+                read.reference_start = s
+                read.mapping_quality = 30
+                read.cigartuples = ((0, READ_LENGTH),)
+                fo.write(read)
+    pysam.index(fp)
+
+
+def generate_dataset(output_dir, n_peaks=20000, n_reads=2000000, genome_size=3.1e9, n_chroms=24, overlap=0.6,
+                     diff_fraction=0.2, fold=4., frip=0.3, seed=0, bam=False):
+    """
+    生成一组完整的模拟数据
+    :return: 文件路径字典, 键为peaks1, peaks2, reads1, reads2, chrom_sizes以及(生成bam时)bam1, bam2
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    sizes_list = chrom_sizes(genome_size, n_chroms)
+    names, sizes = [name for (name, size) in sizes_list], [size for (name, size) in sizes_list]
+    files = {'chrom_sizes': os.path.join(output_dir, 'genome.chrom.sizes')}
+    with open(files['chrom_sizes'], 'w') as fo:
+        fo.writelines('%s\t%d\n' % item for item in sizes_list)
+    all_peaks = generate_peaks(n_peaks, sizes, overlap, diff_fraction, fold, seed)
+    for sample in (1, 2):
+        files['peaks%d' % sample] = os.path.join(output_dir, 'sample%d_peaks.bed' % sample)
+        write_peaks(files['peaks%d' % sample], all_peaks[sample - 1], names)
+        files['reads%d' % sample] = os.path.join(output_dir, 'sample%d_reads.bed' % sample)
+        write_reads_bed(files['reads%d' % sample], iter_reads(all_peaks, sample, n_reads, sizes, frip, seed), names)
+        if bam:
+            files['bam%d' % sample] = os.path.join(output_dir, 'sample%d_reads.bam' % sample)
+            write_reads_bam(files['bam%d' % sample], iter_reads(all_peaks, sample, n_reads, sizes, frip, seed),
+                            names, sizes)
+    return files
+
+
+def add_data_options(opt_parser):
+    """
+    模拟数据的选项，bench_pipeline.py也使用
+    """
+    opt_parser.add_option('--peaks', dest='peaks', type='int', default=20000,
+                          help='number of peaks of each sample, default=20000.')
+    opt_parser.add_option('--reads', dest='reads', type='int', default=2000000,
+                          help='number of reads of each sample, default=2000000.')
+    opt_parser.add_option('--genome-size', dest='genome_size', type='float', default=3.1e9,
+                          help='total length of the chromosomes, default=3.1e9.')
+    opt_parser.add_option('--chroms', dest='chroms', type='int', default=24,
+                          help='number of chromosomes (at most 24), default=24.')
+    opt_parser.add_option('--overlap', dest='overlap', type='float', default=0.6,
+                          help='fraction of peak loci shared by the two samples, default=0.6.')
+    opt_parser.add_option('--diff-fraction', dest='diff_fraction', type='float', default=0.2,
+                          help='fraction of shared loci with differential signal, default=0.2.')
+    opt_parser.add_option('--fold', dest='fold', type='float', default=4.,
+                          help='fold change of the differential loci, default=4.')
+    opt_parser.add_option('--frip', dest='frip', type='float', default=0.3,
+                          help='fraction of reads in peaks, default=0.3.')
+    opt_parser.add_option('--seed', dest='seed', type='int', default=0, help='random seed, default=0.')
+    opt_parser.add_option('--bam', dest='bam', action='store_true', default=False,
+                          help='also write the reads as sorted and indexed BAM files (needs pysam).')
+
+
+def data_params(values):
+    """
+    add_data_options的选项转换成generate_dataset的参数
+    """
+    return dict(n_peaks=values.peaks, n_reads=values.reads, genome_size=values.genome_size, n_chroms=values.chroms,
+                overlap=values.overlap, diff_fraction=values.diff_fraction, fold=values.fold, frip=values.frip,
+                seed=values.seed, bam=values.bam)
+
+
+def main():
+    opt_parser = OptionParser(usage='%prog -o output_folder [options]')
+    opt_parser.add_option('-o', dest='output', help='folder to write the data into.')
+    add_data_options(opt_parser)
+    values, _ = opt_parser.parse_args()
+    if not values.output:
+        opt_parser.error('-o is required')
+    files = generate_dataset(values.output, **data_params(values))
+    for key in sorted(files):
+        print '%s\t%s' % (key, files[key])
+
+
+if __name__ == '__main__':
+    main()
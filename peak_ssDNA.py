@@ -10,6 +10,21 @@ import pandas as pd
 import re
 import os.path
 import sys
+import mmap
+import string
+import itertools
+from multiprocessing import Pool
+from optparse import OptionParser
+
+# row of each base in the one-hot matrix (A, C, G, T); any other character is 4 and stays all-zero
+BASES = 'ACGT'
+BASE_CODE = np.empty(256,dtype=np.uint8)
+BASE_CODE.fill(4)
+for code,base in enumerate(BASES):
+    BASE_CODE[ord(base)] = BASE_CODE[ord(base.lower())] = code
+COMPLEMENT_CODE = np.array([3,2,1,0,4],dtype=np.uint8)
+COMPLEMENT_TABLE = string.maketrans('ACGTacgt','TGCAtgca')
+PEAK_COLUMNS = ['chr','start','end','name','summit','strand']
 
 def load_peak(peaks_path,genome_path,peak_len,peak_type,center=False):
     '''
@@ -18,20 +33,43 @@ def load_peak(peaks_path,genome_path,peak_len,peak_type,center=False):
     
     if peak_type == "bed6col":# normal bed file
         print '%s is a 6-column bed file.'%os.path.basename(peaks_path)
-        peak = pd.read_csv(peaks_path, '\t' ,names=['chr','start','end','name','summit','strand'])
+        peak = pd.read_csv(peaks_path, '\t' ,names=PEAK_COLUMNS)
         if len(peak)==0:
             print 'Warning: No peaks detected in peak file. Exiting...'
             exit(2)
-        if peak['summit'].dtype != 'int64':
-                print 'Invalid summit! Please use option -f to specify your peak format!'
-                exit(0)
-        peak['summit'] = (peak['start'] + peak['end'])//2 
-        if (peak['summit']>peak['end']).any():
-            print 'Invalid d.Series(minimum,index=motif_table.index)summit! Please use option -f to specify your peak format!'
-            exit(0)
     else:
         print 'Invalid peak file format! Please use option -f to specify your peak format!'
         exit(1)
+    peak = set_sequence_interval(peak,peak_len,center)
+    n_peak = len(peak)
+    genome = GenomeFasta(genome_path)
+    peak['seq'] = genome.fetch_batch(peak['chr'],peak['seq_start'],peak['seq_end'])
+    genome.close()
+
+    if center:
+        # sequences of the same length: one N x 4 x L block, each peak keeps a view trimmed to its own length
+        # (shorter only at the chromosome ends)
+        lengths = np.array([len(seq) for seq in peak['seq']],dtype=np.int64)
+        seq_matrix = one_hot_encode(peak['seq'],peak['strand'])
+        peak['seq_matrix'] = [seq_matrix[i,:,:lengths[i]] for i in xrange(n_peak)]
+    else:
+        # peaks of different widths are not padded to the widest one: a view of the concatenated sequences each
+        seq_matrix,offsets = one_hot_encode_concat(peak['seq'],peak['strand'])
+        peak['seq_matrix'] = [seq_matrix[:,offsets[i]:offsets[i+1]] for i in xrange(n_peak)]
+
+    return peak
+
+def set_sequence_interval(peak,peak_len,center=False):
+    '''
+    check the summits of a 6-column bed table and add the seq_start/seq_end columns of the sequences to extract
+    '''
+    if peak['summit'].dtype != 'int64':
+            print 'Invalid summit! Please use option -f to specify your peak format!'
+            exit(0)
+    peak['summit'] = (peak['start'] + peak['end'])//2 
+    if (peak['summit']>peak['end']).any():
+        print 'Invalid d.Series(minimum,index=motif_table.index)summit! Please use option -f to specify your peak format!'
+        exit(0)
     if center:
         peak['seq_start'] = peak['summit'] - peak_len//2
         peak.ix[peak['seq_start']<0,'seq_start'] = 0
@@ -39,47 +77,300 @@ def load_peak(peaks_path,genome_path,peak_len,peak_type,center=False):
     else:
         peak['seq_start'] = peak['start']
         peak['seq_end'] = peak['end']
-    n_peak = len(peak)
-    genome_iter = [genome_path]*n_peak
-    peak['seq'] = map(extract_sequence,genome_iter,peak['chr'],peak['seq_start'],peak['seq_end'])
+    return peak
+
+def read_fai(fai_path):
+    '''
+    read a samtools .fai index: {name: (length, offset, line_bases, line_width)}
+    '''
+    index = {}
+    with open(fai_path) as fi:
+        for line in fi:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) >= 5:
+                index[fields[0]] = tuple(int(x) for x in fields[1:5])
+    return index
+
+def build_fai(fasta_path):
+    '''
+    scan a (multi-)FASTA file and build its .fai index; every line of a sequence except the last
+    must have the same width. The index is saved next to the FASTA file when the folder is writable.
+    '''
+    index,names = {},[]
+    name = None
+    with open(fasta_path,'rb') as fi:
+        offset = 0
+        for line in fi:
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                names.append(name)
+                # [length, offset, line_bases, line_width, short line seen]
+                index[name] = [0,offset+len(line),0,0,False]
+            elif name is not None:
+                entry = index[name]
+                bases = len(line.rstrip('\r\n'))
+                if bases == 0:
+                    # blank lines are only allowed at the end of a sequence
+                    entry[4] = entry[2] > 0
+                    offset += len(line)
+                    continue
+                if entry[4] or bases > entry[2] > 0:
+                    raise ValueError('%s: lines of %s have different widths, cannot be indexed'%(fasta_path,name))
+                if entry[2] == 0:
+                    entry[2],entry[3] = bases,len(line)
+                elif bases < entry[2] or len(line) != entry[3]:
+                    entry[4] = True
+                entry[0] += bases
+            offset += len(line)
+    index = dict((name,tuple(entry[:4])) for name,entry in index.items())
+    try:
+        with open(fasta_path+'.fai','w') as fo:
+            for name in names:
+                fo.write('%s\t%d\t%d\t%d\t%d\n'%((name,)+index[name]))
+    except (IOError,OSError):
+        pass
+    return index
 
-    peak['seq_matrix'] = map(construct_sequence_matrix_by_strand,peak['seq'],peak['strand'])
+def load_fai(fasta_path):
+    '''
+    use the .fai index of the FASTA file, build it if it is missing or older than the FASTA file
+    '''
+    fai_path = fasta_path+'.fai'
+    if os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(fasta_path):
+        return read_fai(fai_path)
+    return build_fai(fasta_path)
 
-    return peak
+class GenomeFasta(object):
+    '''
+    indexed access to a genome, either a single (multi-)FASTA file or a folder with one FASTA file per
+    chromosome named after the chromosome. Each file is memory-mapped once, and a sequence is a slice
+    of the mapped file, so the line width is taken from the index and not assumed.
+    '''
+    def __init__(self,genome_path):
+        self.genome_path = genome_path
+        self._files = {}    # file path -> (mmap, index)
+        if not os.path.isdir(genome_path):
+            self._open(genome_path)
+
+    def _open(self,fasta_path):
+        if fasta_path not in self._files:
+            index = load_fai(fasta_path)
+            with open(fasta_path,'rb') as fi:
+                data = mmap.mmap(fi.fileno(),0,access=mmap.ACCESS_READ)
+            self._files[fasta_path] = (data,index)
+        return self._files[fasta_path]
+
+    def _chromosome(self,chr):
+        '''
+        the mapped file and the index entry of a chromosome
+        '''
+        if os.path.isdir(self.genome_path):
+            for name in (chr,chr+'.fa',chr+'.fasta'):
+                fasta_path = os.path.join(self.genome_path,name)
+                if os.path.isfile(fasta_path):
+                    break
+            else:
+                raise KeyError('chromosome %s not found in %s'%(chr,self.genome_path))
+            data,index = self._open(fasta_path)
+            # one chromosome per file: the file name decides, whatever the header says
+            entry = index[chr] if chr in index else index.values()[0]
+        else:
+            data,index = self._open(self.genome_path)
+            if chr not in index:
+                raise KeyError('chromosome %s not found in %s'%(chr,self.genome_path))
+            entry = index[chr]
+        return data,entry
+
+    def fetch(self,chr,bpstart,bpend):
+        # 0-based: bpstart is included while bpend is not included.
+        return self.fetch_batch([chr],[bpstart],[bpend])[0]
+
+    def fetch_batch(self,chrs,bpstarts,bpends):
+        '''
+        upper-case sequences of all the intervals, in the same order; intervals are clipped to the chromosome
+        '''
+        chrs = np.asarray(chrs)
+        bpstarts,bpends = np.asarray(bpstarts,dtype=np.int64),np.asarray(bpends,dtype=np.int64)
+        seqs = [None]*len(chrs)
+        for chr in np.unique(chrs):
+            idx = np.where(chrs == chr)[0]
+            data,(length,offset,line_bases,line_width) = self._chromosome(chr)
+            line_bases = max(line_bases,1)
+            starts = np.clip(bpstarts[idx],0,length)
+            ends = np.clip(bpends[idx],starts,length)
+            # byte offset of a base: the preceding full lines plus the position in its line
+            byte_starts = offset + starts//line_bases*line_width + starts%line_bases
+            byte_ends = offset + ends//line_bases*line_width + ends%line_bases
+            for i,bs,be in zip(idx.tolist(),byte_starts.tolist(),byte_ends.tolist()):
+                seqs[i] = data[bs:be].replace('\n','').replace('\r','').upper()
+        return seqs
+
+    def close(self):
+        for data,_ in self._files.values():
+            data.close()
+        self._files = {}
 
 def extract_sequence(genome,chr,bpstart,bpend):
     # 0-based: bpstart is included while bpend is not included.
-    gf = file('%s/%s'%(genome,chr))
-    gf.seek(0,0)
-    gf.readline()  #read the first line; the pointer is at the second line
-    nbp = bpend - bpstart
-    offset = bpstart + np.floor(bpstart/50) #assuming each line contains 50 characters; add 1 offset per line
-    gf.seek(offset,1)
-    seq_tmp = gf.read(nbp+int(np.floor(nbp/50))+1)
-    seq_tmp = seq_tmp.replace('\n','')
-    gf.close()
-    return seq_tmp[0:nbp].upper()
-    
+    # genome is a GenomeFasta, or a genome path which is then opened for this one sequence
+    if isinstance(genome,GenomeFasta):
+        return genome.fetch(chr,bpstart,bpend)
+    genome = GenomeFasta(genome)
+    try:
+        return genome.fetch(chr,bpstart,bpend)
+    finally:
+        genome.close()
+
+def sequence_codes(seqs,strands=None,length=None):
+    '''
+    base codes (A=0, C=1, G=2, T=3, others 4) of all sequences as an N x L uint8 array, L is the longest
+    sequence unless given; shorter sequences are padded with 4 at the end. Sequences on the '-' strand are
+    reverse-complemented within their own length.
+    '''
+    seqs = list(seqs)
+    n = len(seqs)
+    lengths = np.array([len(seq) for seq in seqs],dtype=np.int64)
+    if length is None:
+        length = int(lengths.max()) if n else 0
+    codes = np.empty((n,length),dtype=np.uint8)
+    codes.fill(4)
+    minus = np.array([strand == '-' for strand in strands] if strands is not None else [False]*n,dtype=bool)
+    # sequences of the same length are decoded together as one block (all of them when the peaks are centered)
+    for seq_len in np.unique(lengths):
+        if seq_len == 0 or length == 0:
+            continue
+        idx = np.where(lengths == seq_len)[0]
+        block = BASE_CODE[np.frombuffer(''.join([seqs[i] for i in idx]),dtype=np.uint8)].reshape(len(idx),seq_len)
+        flip = minus[idx]
+        if flip.any():
+            # reverse the '-' strand sequences, complement: A<->T and C<->G are codes 3-code
+            block[flip] = COMPLEMENT_CODE[block[flip][:,::-1]]
+        codes[idx,:min(seq_len,length)] = block[:,:length]
+    return codes
+
+def one_hot_encode(seqs,strands=None,length=None):
+    '''
+    one-hot encode all sequences into one N x 4 x L uint8 array (rows A, C, G, T), see sequence_codes
+    '''
+    codes = sequence_codes(seqs,strands,length)
+    return np.equal(codes[:,np.newaxis,:],np.arange(4,dtype=np.uint8)[np.newaxis,:,np.newaxis]).view(np.uint8)
+
+def one_hot_encode_concat(seqs,strands=None):
+    '''
+    one-hot encode sequences of different lengths without padding: one 4 x (total length) uint8 array of the
+    sequences side by side (rows A, C, G, T) and their N+1 offsets, sequence i is matrix[:,offsets[i]:offsets[i+1]].
+    Sequences on the '-' strand are reverse-complemented.
+    '''
+    seqs = list(seqs)
+    if strands is not None:
+        seqs = [seq[::-1].translate(COMPLEMENT_TABLE) if strand == '-' else seq for seq,strand in zip(seqs,strands)]
+    offsets = np.zeros(len(seqs)+1,dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs],out=offsets[1:])
+    codes = BASE_CODE[np.frombuffer(''.join(seqs),dtype=np.uint8)]
+    matrix = np.equal(codes[np.newaxis,:],np.arange(4,dtype=np.uint8)[:,np.newaxis]).view(np.uint8)
+    return matrix,offsets
+
 def construct_sequence_matrix_by_strand(seq,strand):
-    matrix = np.zeros((4,len(seq)))
-    if strand == "+":
-        for base,idx in zip(seq,np.arange(len(seq))):
-            if base == 'A':
-                matrix[0][idx] = 1
-            elif base == 'C':
-                matrix[1][idx] = 1
-            elif base == 'G':
-                matrix[2][idx] = 1
-            elif base == 'T':
-                matrix[3][idx] = 1
-    else:
-        for base,idx in zip(seq,np.arange(len(seq))):
-            if base == 'T':
-                matrix[0][idx] = 1
-            elif base == 'G':
-                matrix[1][idx] = 1
-            elif base == 'C':
-                matrix[2][idx] = 1
-            elif base == 'A':
-                matrix[3][idx] = 1
-    return matrix    
\ No newline at end of file
+    return one_hot_encode([seq],[strand])[0]
+
+# parameters of encode_peak_file for the worker processes, set before the pool is forked
+_encode_params = {}
+_genomes = {}
+
+def _encode_chunk(args):
+    '''
+    extract and encode one chunk of peaks into its rows of the on-disk matrix
+    '''
+    offset,peak = args
+    genome_path,matrix_path,peak_len = _encode_params['genome'],_encode_params['matrix'],_encode_params['peak_len']
+    if genome_path not in _genomes:
+        _genomes[genome_path] = GenomeFasta(genome_path)
+    seqs = _genomes[genome_path].fetch_batch(peak['chr'],peak['seq_start'],peak['seq_end'])
+    matrix = np.load(matrix_path,mmap_mode='r+')
+    matrix[offset:offset+len(peak)] = one_hot_encode(seqs,peak['strand'],peak_len)
+    matrix.flush()
+    del matrix
+    return peak
+
+def count_peaks(peaks_path):
+    with open(peaks_path) as fi:
+        return sum(1 for line in fi if line.strip())
+
+def iter_peak_chunks(peaks_path,peak_len,center=False,chunk_size=10000):
+    '''
+    read the 6-column bed file chunk by chunk: (row offset of the chunk, peak table with the sequence intervals)
+    '''
+    offset = 0
+    for peak in pd.read_csv(peaks_path, '\t' ,names=PEAK_COLUMNS,chunksize=chunk_size):
+        peak = set_sequence_interval(peak,peak_len,center)
+        yield offset,peak
+        offset += len(peak)
+
+def encode_peak_file(peaks_path,genome_path,output_prefix,peak_len,center=False,chunk_size=10000,processes=1):
+    '''
+    stream a 6-column bed file through sequence extraction and one-hot encoding in chunks, so the memory use
+    does not grow with the number of peaks. The chunks are spread over a pool of processes and written into
+    an N x 4 x peak_len uint8 .npy file (rows in the order of the peak file, sequences longer than peak_len
+    are cut, shorter ones padded with zeros); the intervals of the rows are written into a bed file.
+    :return: (path of the .npy matrix, path of the bed file)
+    '''
+    n_peak = count_peaks(peaks_path)
+    if n_peak == 0:
+        print 'Warning: No peaks detected in peak file. Exiting...'
+        exit(2)
+    matrix_path,bed_path = output_prefix+'_seq_matrix.npy',output_prefix+'_seq_peaks.bed'
+    matrix = np.lib.format.open_memmap(matrix_path,mode='w+',dtype=np.uint8,shape=(n_peak,4,peak_len))
+    del matrix
+    _encode_params.update({'genome':genome_path,'matrix':matrix_path,'peak_len':peak_len})
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        chunks = iter_peak_chunks(peaks_path,peak_len,center,chunk_size)
+        with open(bed_path,'w') as fo:
+            # a few chunks per process at a time, so that only these are held in memory
+            while True:
+                wave = list(itertools.islice(chunks,2*max(processes,1)))
+                if not wave:
+                    break
+                done = pool.map(_encode_chunk,wave,chunksize=1) if pool is not None else map(_encode_chunk,wave)
+                for peak in done:
+                    peak.to_csv(fo,sep='\t',header=False,index=False,
+                                columns=['chr','seq_start','seq_end','name','summit','strand'])
+                print '%d/%d peaks encoded'%(wave[-1][0]+len(wave[-1][1]),n_peak)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _encode_params.clear()
+        for genome in _genomes.values():
+            genome.close()
+        _genomes.clear()
+    return matrix_path,bed_path
+
+def main():
+    opt_parser = OptionParser(usage='%prog -p peaks.bed -g genome -o output_prefix [options]')
+    opt_parser.add_option('-p','--peak',dest='peak',help='6-column bed file of the peaks.')
+    opt_parser.add_option('-g','--genome',dest='genome',
+                          help='genome FASTA file, or a folder with one FASTA file per chromosome.')
+    opt_parser.add_option('-o','--output',dest='output',help='prefix of the output files.')
+    opt_parser.add_option('-f','--format',dest='format',default='bed6col',help='peak file format, default=bed6col.')
+    opt_parser.add_option('-l','--length',dest='length',type='int',default=1000,
+                          help='length of the encoded sequences, default=1000.')
+    opt_parser.add_option('--center',dest='center',action='store_true',default=False,
+                          help='take the sequences around the peak summits instead of the whole peaks.')
+    opt_parser.add_option('--chunk-size',dest='chunk_size',type='int',default=10000,
+                          help='number of peaks processed at a time, default=10000.')
+    opt_parser.add_option('-t','--threads',dest='threads',type='int',default=1,
+                          help='number of processes, default=1.')
+    values,_ = opt_parser.parse_args()
+    if not (values.peak and values.genome and values.output):
+        opt_parser.print_help()
+        exit(1)
+    if values.format != 'bed6col':
+        print 'Invalid peak file format! Please use option -f to specify your peak format!'
+        exit(1)
+    matrix_path,bed_path = encode_peak_file(values.peak,values.genome,values.output,values.length,values.center,
+                                            values.chunk_size,values.threads)
+    print 'sequence matrix: %s\npeaks: %s'%(matrix_path,bed_path)
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,6 @@ install_requires = [
     "bisect",
     "math",
     "random",
-    "statsmodels",
     "matplotlib",
     "pysam"
 ]
@@ -40,7 +39,7 @@ setup(
     download_url="xxxxxx",
     package_dir={'MAnorm': 'MAnorm'},
     packages=['MAnorm'],
-    scripts=['bin/MAnorm'],
+    scripts=['bin/MAnorm', 'bin/MAnorm_batch'],
     classifiers=CLASSIFIERS,
 )
 